@@ -19,11 +19,66 @@ import sqlite3
 import binascii
 from multiprocessing import Pool
 import argparse
+from pathlib import Path
 
 
 ids = dict()
 
 
+# SQLite settings used by connect_db.
+#   * "safe": SQLite defaults.
+#   * "migration": Keeps the rollback journal in memory and doesn't wait for the data to be
+#     written to disk. Additionally, uses a big page cache (256 MiB), memory mapped I/O and
+#     keeps temporary tables in memory. Much faster, but the database may get corrupted if
+#     the computer crashes. Only use it for files that can be recreated (like the copies
+#     made by jellyfin_migrator).
+#     Note: journal_mode OFF would be even faster, but then failed statements can't be rolled
+#     back anymore.
+db_profiles = {
+    "safe": {},
+    "migration": {
+        "journal_mode": "MEMORY",
+        "synchronous": "OFF",
+        "cache_size": -256 * 1024,
+        "mmap_size": 2**30,
+        "temp_store": "MEMORY",
+    },
+}
+
+
+# Connection returned by connect_db. Restores the original journal mode of the database
+# when it's closed.
+class ProfiledConnection(sqlite3.Connection):
+    previous_journal_mode = None
+
+    def close(self):
+        if self.previous_journal_mode is not None:
+            # Same as closing without commit. The journal mode can't be changed within a transaction.
+            if self.in_transaction:
+                self.rollback()
+            self.execute(f"PRAGMA journal_mode = {self.previous_journal_mode}")
+            self.previous_journal_mode = None
+        super().close()
+
+
+# Opens an SQLite database with the settings of the given profile (see db_profiles).
+# Read only databases are opened as immutable, which means SQLite doesn't need to lock
+# them (or check for changes by other processes).
+def connect_db(path, read_only: bool = False, profile: str = "safe") -> sqlite3.Connection:
+    if read_only:
+        con = sqlite3.connect(Path(path).absolute().as_uri() + "?mode=ro&immutable=1", uri=True,
+                              factory=ProfiledConnection)
+    else:
+        con = sqlite3.connect(path, factory=ProfiledConnection)
+    for pragma, value in db_profiles[profile].items():
+        if pragma == "journal_mode":
+            if read_only:
+                continue
+            con.previous_journal_mode = next(con.execute("PRAGMA journal_mode"))[0]
+        con.execute(f"PRAGMA {pragma} = {value}")
+    return con
+
+
 # Functions used for converting IDs between the various formats. See load_ids
 # convert_ancestor_id: regroup bytes to convert from/to ancestor id format (symetric)
 def convert_ancestor_id(id: str):
@@ -60,7 +115,7 @@ def sid2did(id): return "-".join([id[:8], id[8:12], id[12:16], id[16:20], id[20:
 #   * in paths they're grouped in folders by the first two letters:
 #     '.../83/833addde992893e93d0572907f8b4cad/...'
 def load_ids(library_db:str):
-    con = sqlite3.connect(library_db)
+    con = connect_db(library_db, read_only=True)
     cur = con.cursor()
     id_replacements_bin = [x[0] for x in cur.execute("SELECT `guid` FROM `TypedBaseItems`")]
     con.close()
@@ -94,7 +149,7 @@ def load_ids(library_db:str):
 
 # Loads the name of all tables in a sqlite db file as well as each one's columns.
 def load_db_tables_columns(path_to_db):
-    con = sqlite3.connect(path_to_db)
+    con = connect_db(path_to_db, read_only=True)
     cur = con.cursor()
 
     # Get all table names. The query will also return index stuff that isn't required. It's (mostly) filtered.
@@ -117,7 +172,7 @@ def load_db_tables_columns(path_to_db):
 def load_all_rows(path_to_db):
     table_info = load_db_tables_columns(path_to_db)
 
-    con = sqlite3.connect(path_to_db)
+    con = connect_db(path_to_db, read_only=True)
     cur = con.cursor()
 
     rows = []
@@ -17,17 +17,39 @@
 
 import pathlib
 import sqlite3
+import argparse
 import json
 import hashlib
 import binascii
-import xml.etree.ElementTree as ET
+import xml.sax
+from xml.sax.saxutils import XMLGenerator
 from pathlib import Path
-from shutil import copy
+import shutil
+import stat
+import mmap
+from concurrent.futures import ThreadPoolExecutor
 from time import time
+from collections import deque, OrderedDict
+from collections.abc import Mapping
+from array import array
+from bisect import bisect_left
+import sys
+from itertools import count
+from multiprocessing import Pool
 from jellyfin_id_scanner import *
 import datetime
 from string import ascii_letters
 import os
+import re
+import logging
+import queue
+import threading
+import atexit
+try:
+    # Only used for reflinks, which aren't available on Windows anyways.
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 # TODO BEFORE YOU START:
@@ -59,6 +81,16 @@ import os
 #   * Repeat as needed
 # Text encoding is UTF-8 (in npp selectable under "Encoding -> UTF-8")
 log_file = "D:/jf-migrator.log"
+# All messages are written to the log file. To keep the console output readable, only
+# messages of the following level (or higher) are printed there:
+#   * logging.DEBUG: Everything, f.ex. every single file that's copied or processed.
+#   * logging.INFO: Progress of the migration.
+#   * logging.WARNING: Only warnings and errors.
+#   * logging.ERROR: Only errors.
+console_log_level = logging.INFO
+# The log file is written in the background. This is the maximum time (in seconds) it takes
+# for a message to appear in the log file.
+log_flush_interval = 1
 
 
 # These paths will be processed in the order they're listed here.
@@ -139,6 +171,87 @@ fs_path_replacements = {
 original_root = Path("C:/ProgramData/Jellyfin/Server")
 source_root = Path("D:/Jellyfin/Server")
 target_root = Path("D:/Jellyfin-dummy")
+# The progress of the migration is saved in this file (an SQLite database). If the migration
+# gets interrupted, run the script with --resume to continue where it stopped. Once the
+# migration is complete, the file is deleted.
+journal_file = target_root / "jf-migrator-journal"
+# If you merge media files from different folders into fewer ones, some items end up with
+# the same new ID (see the warning printed by get_ids). Only one of the colliding database
+# entries can be kept:
+#   * "drop-new": Keep the entry that already has this ID. If all colliding entries get
+#                 it from the migration, keep the one that was added to the database first.
+#   * "drop-old": Keep the entry that gets this ID from the migration (the one added to the
+#                 database last if there are several).
+#   * "keep-newest": Keep the entry with the latest DateModified. Tables without a
+#                    DateModified column use "drop-new".
+id_collision_policy = "drop-new"
+
+
+# Performance settings. The defaults should work fine for most installations.
+# Only touch them if the script is too slow or uses too much memory on your
+# machine.
+#
+# Number of database rows that are read, processed and written back at once.
+# The changes are committed to the database after each batch.
+db_batch_size = 10000
+# Number of worker processes used to update the paths in big database tables.
+# None means one process per CPU core, 1 disables multiprocessing.
+db_workers = None
+# Database columns in which each value occurs at least this often on average (f.ex. the
+# path of a media file in mediastreams, once for every audio/video/subtitle stream) are
+# updated by processing each distinct value only once. 0 disables this.
+db_distinct_ratio = 2
+# Number of path replacement results that are cached. Larger libraries benefit from a
+# larger cache (see the statistics in the log), at the cost of more memory usage.
+# 0 disables the cache.
+replacement_cache_size = 100000
+# Metadata files (.xml, .nfo, .json, .mblink) are scanned for the paths/IDs to replace before
+# they're parsed. Files that don't contain any of them are left as they are. Note that this
+# also skips the warnings about unknown paths in these files (see recursive_root_path_replacer).
+skip_unmatched_files = True
+# Files larger than this many bytes are scanned for skip_unmatched_files through mmap instead
+# of reading them into memory.
+file_mmap_size = 1024 * 1024
+# Only process the XML tags (per type of XML file) that are known to contain paths or IDs.
+# They're learned by scanning all XML/NFO files of source_root once; the result is saved in
+# xml_tag_index_file and reused by later runs. Delete that file to scan again, f.ex. if you
+# updated jellyfin or added new plugins. Files of types not found by the scan are processed
+# completely. By default, the file is saved next to the log file; target_root is meant to
+# contain nothing but the migrated files.
+use_xml_tag_index = False
+xml_tag_index_file = Path(log_file).with_name("jf-migrator-xml-tags.json")
+# JSON columns are updated by rewriting only the affected strings within the JSON text (see
+# replace_json_value). Every json_verify_interval-th value is additionally processed the slow
+# way (decoding and encoding the whole JSON document) and the results are compared. Only
+# meant for debugging; 0 disables the verification.
+json_verify_interval = 0
+# SQLite settings for the databases in target_root (see db_profiles in jellyfin_id_scanner.py).
+# "migration" is a lot faster but the files may get corrupted if your computer crashes.
+# Since they're only copies, just run the migration again in that case. Use "safe" if you
+# work on the original files (which you shouldn't).
+db_profile = "migration"
+# Number of threads copying files. Files that are only copied (copy_only jobs) are copied
+# in the background while the script continues with the next files. Especially useful for
+# network drives and SSDs. 1 copies the files one by one.
+copy_workers = 8
+# Number of threads reading the file dates at the end of the migration. Especially useful
+# if your media files are on a network drive, where each file access takes a while.
+stat_workers = 16
+# On Windows, folders containing at least this many files from the database are listed once
+# (os.scandir) instead of accessing each file on its own. Other systems don't return the file
+# dates with the folder listing; there, the files are always accessed on their own.
+stat_scandir_threshold = 4
+# How copy_only jobs (files that are never modified) create their target files. Can be
+# overridden per job in the todo_list with a "link_mode" entry.
+#   * "copy": Regular copy.
+#   * "hardlink": Hard links; the source and target root must be on the same drive.
+#   * "reflink": Copy-on-write copies (btrfs, XFS, ...). Takes no extra space.
+#   * "symlink": Symbolic links pointing to the source files. Only makes sense if the
+#                source files stay where they are!
+# If a mode isn't possible for a file (f.ex. hard link to another drive), the file is
+# copied instead. Files that are modified later on (by the ID migration) are turned
+# into real copies before they're modified, so the source files stay untouched.
+link_mode = "copy"
 
 
 ### The To-Do Lists: todo_list_paths, todo_list_id_paths and todo_list_ids.
@@ -449,27 +562,363 @@ library_db_source_path = Path()
 
 
 # Similarly, the IDs are used in "hard-to-reach" places and are thus global, too.
-ids = dict()
+ids = None
 
 
-# Custom print function that prints to both the console as well as to a log file
+# Custom print function that prints to both the console as well as to a log file.
+# All messages are written to the log file. Only messages with at least console_log_level
+# are printed to the console.
+# Writing to the log file is done by a background thread (see log_writer) which keeps the
+# file open and flushes it regularly. Each message is handed over through log_queue.
 logging_newline = False
-def print_log(*args, **kwargs):
-    global log_file, logging_newline
-    print(*args, **kwargs)
+log_queue = queue.Queue()
+log_writer_thread = None
+# Worker processes (see update_db_table) write directly to the log file instead. Their
+# buffered messages would get lost when the worker is terminated.
+log_buffered = True
+def print_log(*args, level=logging.INFO, **kwargs):
+    global logging_newline
+    if level >= console_log_level:
+        print(*args, **kwargs)
 
     # Each new line gets a timestamp. That requires tracking of (previous)
     # line endings though. This is not perfect, but perfectly fine for this
     # script.
-    dt = ""
-    if logging_newline:
-        dt = "[" + datetime.datetime.now().isoformat(sep=" ") + "] "
-    if kwargs.get("end", "\n") == "\n":
-        logging_newline = True
+    # The timestamp is only formatted when the message is written.
+    timestamp = time() if logging_newline else None
+    end = kwargs.get("end", "\n")
+    logging_newline = end == "\n"
+
+    # Same output as print(timestamp, *args, sep=sep, end=end, file=f).
+    sep = kwargs.get("sep", " ")
+    message = sep + sep.join([str(arg) for arg in args]) + end
+
+    if log_buffered:
+        if log_writer_thread is None:
+            start_log_writer()
+        log_queue.put((timestamp, message))
     else:
-        logging_newline = False
+        with open(log_file, "a", encoding="utf-8") as f:
+            f.write(format_log_message(timestamp, message))
+
+
+def format_log_message(timestamp, message):
+    if timestamp is None:
+        return message
+    return "[" + datetime.datetime.fromtimestamp(timestamp).isoformat(sep=" ") + "] " + message
+
+
+# Writes the messages from log_queue to the log file until it receives None.
+def log_writer():
     with open(log_file, "a", encoding="utf-8") as f:
-        print(dt, *args, **kwargs, file=f)
+        last_flush = time()
+        while True:
+            try:
+                entry = log_queue.get(timeout=log_flush_interval)
+            except queue.Empty:
+                entry = ()
+            if entry is None:
+                break
+            if entry:
+                f.write(format_log_message(*entry))
+            now = time()
+            if now - last_flush >= log_flush_interval:
+                f.flush()
+                last_flush = now
+
+
+def start_log_writer():
+    global log_writer_thread
+    log_writer_thread = threading.Thread(target=log_writer, name="log_writer", daemon=True)
+    log_writer_thread.start()
+    # Make sure that all messages end up in the log file, no matter how the script ends.
+    atexit.register(stop_log_writer)
+
+
+def stop_log_writer():
+    global log_writer_thread
+    if log_writer_thread is not None:
+        log_queue.put(None)
+        log_writer_thread.join()
+        log_writer_thread = None
+
+
+# Keys of the replacement dicts that are settings rather than actual path replacements.
+replacement_settings = ("target_path_slash", "log_no_warnings")
+
+
+# Jellyfin IDs as they occur in paths (see jellyfin_id_scanner for details on the formats):
+# 32 hexadecimal digits, optionally with dashes. Surrounding hex digits mean it's something else.
+id_chars = frozenset("0123456789abcdef-")
+id_token = re.compile(r"(?<![0-9a-f-])(?:[0-9a-f]{32}|[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})(?![0-9a-f-])")
+
+
+compiled_replacements_counter = count()
+
+
+# Replacement dict that has been prepared for fast path lookups (see compile_replacements).
+# It still is (and behaves like) the dict it was created from.
+# The paths to replace are stored in a tree of their (normalized) components. Finding the
+# matching entry for a path therefore requires a single walk through that tree instead of
+# checking the path against every entry of the dict. If several entries match, the first
+# one from the dict wins, just like when checking them one by one in order.
+class CompiledReplacements(dict):
+    def __init__(self, replacements: dict, ids=None):
+        super().__init__(replacements)
+        # The ID replacements can be passed separately as IdMap view (see IdMap). Then the dict
+        # itself only contains the settings.
+        self.ids = ids
+        # The tree is only built when it's actually needed. Some replacement dicts (f.ex. the ID
+        # replacements) are huge and never used for path root replacements.
+        self.tree = None
+        self.first_chars = None
+        self.ids_are_guids = None
+        # Regex matching the raw content of files that may contain a path to replace, False if
+        # it's not possible to tell (see may_match).
+        self.path_pattern = None
+        # Identifies this dict in the replacement cache. The process ID makes sure that dicts
+        # created by different (worker) processes can be told apart.
+        self.cache_id = (os.getpid(), next(compiled_replacements_counter))
+
+    def compile(self):
+        # Each node of the tree is a dict with the next path components as keys. The None key
+        # marks a node where the path of an entry ends. Its value contains the index of the
+        # entry within the dict and everything needed to build the new path.
+        self.tree = dict()
+        for i, (src, dst) in enumerate(self.items()):
+            if src in replacement_settings:
+                continue
+            node = self.tree
+            for part in Path(src).parts:
+                node = node.setdefault(os.path.normcase(part), dict())
+            if None in node:
+                # Entry with the same path earlier in the dict. That one wins.
+                continue
+            # Prefix for the remaining part of the path, such that prefix + "/".join(remaining parts)
+            # is the same as (dst / remaining parts).as_posix().
+            dst = Path(dst)
+            prefix = dst.as_posix()
+            if not dst.parts:
+                prefix = ""
+            elif not prefix.endswith("/") and not (dst.drive and not dst.root and len(dst.parts) == 1):
+                prefix += "/"
+            node[None] = (i, dst.as_posix(), prefix)
+
+        # Any path starting with a different character than those can't be relative to any of the
+        # entries. This allows to skip most of the strings that aren't paths without parsing them.
+        # Paths starting with "." may be normalized to something else, hence they're always checked.
+        self.first_chars = {os.path.normcase(part[0]) for part in self.tree if part} | {"."}
+        if None in self.tree:
+            # Entry with an empty path. Every relative path is relative to it.
+            self.first_chars = None
+
+    # Returns the new path string of the given path (string or Path object) or None if no
+    # entry of the dict matches.
+    def replace_path(self, d):
+        if self.tree is None:
+            self.compile()
+        if type(d) is str and self.first_chars is not None \
+                and os.path.normcase(d[:1]) not in self.first_chars:
+            return None
+        p = Path(d)
+        parts = p.parts
+        node = self.tree
+        match, match_depth = None, 0
+        if not p.anchor:
+            # Entry with an empty path. Only relative paths are relative to it.
+            match = node.get(None)
+        for depth, part in enumerate(parts, 1):
+            node = node.get(os.path.normcase(part))
+            if node is None:
+                break
+            if None in node and (match is None or node[None][0] < match[0]):
+                match, match_depth = node[None], depth
+        if match is None:
+            return None
+        i, dst, prefix = match
+        remaining = parts[match_depth:]
+        if not remaining:
+            p = dst
+        else:
+            p = prefix + "/".join(remaining)
+        # I guess 99% of the users won't migrate _to_ windows but the script could generate
+        # \ paths anyways.
+        # as_posix() makes sure that we always get a string with "/". Otherwise, on windows,
+        # str(p) would automatically return "\" paths.
+        return p.replace("/", self["target_path_slash"])
+
+    # The fast checks for IDs (see id_token) only work if all IDs have the usual format (which
+    # is always the case for an IdMap).
+    def check_ids_are_guids(self) -> bool:
+        if self.ids_are_guids is None:
+            self.ids_are_guids = self.ids is not None \
+                or all(k in replacement_settings or id_token.fullmatch(k) for k in self)
+        return self.ids_are_guids
+
+    # Returns False if replace_method (replace_path or replace_id_path) certainly returns None
+    # for the string d. Only a cheap check, without splitting d into its path parts.
+    def may_replace(self, d: str, replace_method) -> bool:
+        if replace_method == CompiledReplacements.replace_path:
+            if self.tree is None:
+                self.compile()
+            return self.first_chars is None or os.path.normcase(d[:1]) in self.first_chars
+        if replace_method == CompiledReplacements.replace_id_path:
+            return not self.check_ids_are_guids() or id_token.search(d) is not None
+        return True
+
+    # Returns the new path string of the given path (string or Path object) if one of its parts
+    # is an ID from the dict, None otherwise. See recursive_id_path_replacer for details.
+    def replace_id_path(self, d):
+        ids = self if self.ids is None else self.ids
+        # IDs that have been looked up already, such that each one is only looked up once.
+        found = dict()
+        if type(d) is str and self.check_ids_are_guids():
+            # Single pass through the string to find all candidates for an ID. Most strings don't
+            # contain any (or only IDs that don't change), no need to look at their path parts then.
+            for token in id_token.findall(d):
+                found[token] = ids.get(token)
+                if found[token] is not None:
+                    break
+            else:
+                return None
+
+        p = Path(d)
+        parts = list(p.parts)
+        if not parts:
+            return None
+
+        # The file name (without extension) can be an ID.
+        stem = p.stem
+        dst = None
+        if id_chars.issuperset(stem):
+            dst = found[stem] if stem in found else ids.get(stem)
+        if dst:
+            parts[-1] = dst + p.suffix
+        else:
+            # Otherwise, look for the first folder that is an ID.
+            for src in parts[:-1]:
+                # Check if it can actually be an ID. If so, look it up.
+                if id_chars.issuperset(src):
+                    dst = found[src] if src in found else ids.get(src)
+                    if dst:
+                        break
+            else:
+                return None
+            # The last folder with that name is replaced.
+            i = len(parts) - 2 - parts[-2::-1].index(src)
+            parts[i] = dst
+            # Check if the parent folder starts with byte(s) from the id. If so, replace the
+            # required number of bytes. The root of the path (f.ex. "/" or "C:\") is no folder.
+            parent = parts[i - 1] if i > 1 or (i == 1 and not p.anchor) else ""
+            if parent and src.startswith(parent):
+                parts[i - 1] = dst[:len(parent)]
+
+        # I guess 99% of the users won't migrate _to_ windows but the script could generate
+        # \ paths anyways.
+        # as_posix() makes sure that we always get a string with "/". Otherwise, on windows,
+        # str(p) would automatically return "\" paths.
+        if p.anchor:
+            # The root (f.ex. "/" or "C:\") already ends with a slash.
+            p = parts[0].replace("\\", "/") + "/".join(parts[1:])
+        else:
+            p = "/".join(parts)
+        return p.replace("/", self["target_path_slash"])
+
+
+    # Returns whether the raw content of a file (bytes or mmap) may contain anything that
+    # replace_method (replace_path or replace_id_path) would replace. It may return True for
+    # content without anything to replace, but never False for content with something to replace.
+    def may_match(self, data, replace_method) -> bool:
+        if replace_method == CompiledReplacements.replace_id_path:
+            ids = self if self.ids is None else self.ids
+            if self.ids is None and not all(k in replacement_settings or id_token.fullmatch(k) for k in self):
+                return True
+            # Check every ID sized part of every sequence of ID characters. Unlike id_token, this
+            # doesn't depend on the characters surrounding the IDs (which may be escaped in the file).
+            for m in re.finditer(rb"[0-9a-f-]{32,}", data):
+                token = m.group().decode("ascii")
+                for length in (32, 36):
+                    for i in range(len(token) - length + 1):
+                        if token[i:i + length] in ids:
+                            return True
+            return False
+
+        if self.path_pattern is None:
+            # Any path that is relative to an entry contains all its parts. Of each entry, the
+            # longest part that is written the same in all file formats (no characters that
+            # might be escaped) is searched for. Without such a part, nothing can be ruled out.
+            needles = []
+            for src in self:
+                if src in replacement_settings:
+                    continue
+                p = Path(src)
+                parts = [part for part in p.parts[1 if p.anchor else 0:]
+                         if part not in (".", "..") and part.isascii() and part.isprintable()
+                         and not any(c in part for c in "&<>\"'\\")]
+                if not parts:
+                    needles = None
+                    break
+                needles.append(max(parts, key=len))
+            if needles is None:
+                self.path_pattern = False
+            else:
+                # os.path.normcase makes the paths case-insensitive on windows.
+                flags = re.IGNORECASE if os.path.normcase("A") == "a" else 0
+                self.path_pattern = re.compile(b"|".join(re.escape(n.encode("ascii")) for n in needles), flags)
+        if self.path_pattern is False:
+            return True
+        return self.path_pattern.search(data) is not None
+
+
+# Prepares a replacement dict (like path_replacements) for the replacer functions. They accept
+# plain dicts, too, but then they have to prepare them on every call.
+# Already compiled dicts are returned as they are.
+def compile_replacements(replacements: dict) -> CompiledReplacements:
+    if isinstance(replacements, CompiledReplacements):
+        return replacements
+    return CompiledReplacements(replacements)
+
+
+# The same paths (and path prefixes) occur over and over again: in the different tables and columns
+# of library.db, in the .nfo files, in update_file_dates, ... Hence, the results of the replacements
+# are cached. The cache is shared by all (compiled) replacement dicts and keeps the most recently
+# used results. Only strings that may be paths are cached (see CompiledReplacements.may_replace);
+# titles, overviews and the like would just push the paths out of the cache.
+replacement_cache = OrderedDict()
+replacement_cache_stats = {"hits": 0, "misses": 0}
+
+
+# Returns the result of replace_method(to_replace, d) (replace_method being a method of
+# CompiledReplacements), either from the cache or by calling it.
+def cached_replacement(to_replace, replace_method, d):
+    if type(d) is not str or replacement_cache_size <= 0:
+        return replace_method(to_replace, d)
+    if not to_replace.may_replace(d, replace_method):
+        return None
+    key = (to_replace.cache_id, replace_method, d)
+    try:
+        result = replacement_cache[key]
+    except KeyError:
+        replacement_cache_stats["misses"] += 1
+        result = replace_method(to_replace, d)
+        replacement_cache[key] = result
+        if len(replacement_cache) > replacement_cache_size:
+            # Remove the least recently used result.
+            replacement_cache.popitem(last=False)
+    else:
+        replacement_cache_stats["hits"] += 1
+        replacement_cache.move_to_end(key)
+    return result
+
+
+# Prints how well the replacement cache performed since the last call. This can be used to
+# determine a good replacement_cache_size for your installation.
+def print_replacement_cache_stats():
+    hits, misses = replacement_cache_stats["hits"], replacement_cache_stats["misses"]
+    if hits + misses:
+        print_log(f"Replacement cache: {hits} hits, {misses} misses ({100 * hits / (hits + misses):.1f}% hit rate), "
+                  f"{len(replacement_cache)} / {replacement_cache_size} entries used.")
+    replacement_cache_stats["hits"], replacement_cache_stats["misses"] = 0, 0
 
 
 # Recursively replace all paths in "d" which can be
@@ -481,6 +930,7 @@ def print_log(*args, **kwargs):
 #  * anything else is returned unmodified.
 # Returns the (un)modified object as well as how many items have been modified or ignored.
 def recursive_root_path_replacer(d, to_replace: dict):
+    to_replace = compile_replacements(to_replace)
     modified, ignored = 0, 0
     if type(d) is dict:
         for k, v in d.items():
@@ -493,40 +943,25 @@ def recursive_root_path_replacer(d, to_replace: dict):
             modified += mo
             ignored  += ig
     elif type(d) is str or isinstance(d, pathlib.PurePath):
-        try:
-            p = Path(d)
-        except:
-            # This actually doesn't occur I think; Path() can pretty much convert any string into a Path
-            # object (which is equivalent to saying it doesn't have any restrictions for filenames).
-            ignored += 1
+        # This filters out all the "garbage" paths that actually were no paths to begin with
+        # and of course all the paths that are actually not relative to any src path.
+        p = cached_replacement(to_replace, CompiledReplacements.replace_path, d)
+        if p is not None:
+            d = p
+            modified += 1
         else:
-            found = False
-            for src, dst in to_replace.items():
-                if p.is_relative_to(src):
-                    # This filters out all the "garbage" paths that actually were no paths to begin with
-                    # and of course all the paths that are actually not relative to the src, dst couple
-                    # currently checked.
-                    p = dst / p.relative_to(src)
-                    # I guess 99% of the users won't migrate _to_ windows but the script could generate
-                    # \ paths anyways.
-                    # p.as_posix() makes sure that we always get a string with "/". Otherwise, on windows,
-                    # str(p) would automatically return "\" paths.
-                    d = p.as_posix().replace("/", to_replace["target_path_slash"])
-                    found = True
-                    break
-            if found:
-                modified += 1
-            else:
-                ignored += 1
-                # No need to consider all the Path("sometext") objects. This might not be 100%
-                # accurate, but it eliminates 99.9999% of the false-positives. This output is
-                # after all only to give you a hint whether you missed a path.
-                # Also exclude URLs. Btw: pathlib can be quite handy for messing with URLs.
-                if len(p.parents) > 1 \
-                        and not d.startswith("https:") \
-                        and not d.startswith("http:") \
-                        and not to_replace.get("log_no_warnings", False):
-                    print_log(f"No entry for this (presumed) path: {d}")
+            ignored += 1
+            # No need to consider all the Path("sometext") objects. This might not be 100%
+            # accurate, but it eliminates 99.9999% of the false-positives. This output is
+            # after all only to give you a hint whether you missed a path.
+            # Also exclude URLs. Btw: pathlib can be quite handy for messing with URLs.
+            # Strings without any slashes can't have more than one parent, no need to check them.
+            if not to_replace.get("log_no_warnings", False) \
+                    and (type(d) is not str or "/" in d or os.sep in d) \
+                    and len(Path(d).parents) > 1 \
+                    and not str(d).startswith("https:") \
+                    and not str(d).startswith("http:"):
+                print_log(f"No entry for this (presumed) path: {d}", level=logging.WARNING)
     return d, modified, ignored
 
 
@@ -537,6 +972,7 @@ def recursive_root_path_replacer(d, to_replace: dict):
 # Sometimes the parent folder is just single digit. This code handles any subsring that
 # starts at the beginning of the id string.
 def recursive_id_path_replacer(d, to_replace: dict):
+    to_replace = compile_replacements(to_replace)
     modified, ignored = 0, 0
     if type(d) is dict:
         for k, v in d.items():
@@ -549,68 +985,272 @@ def recursive_id_path_replacer(d, to_replace: dict):
             modified += mo
             ignored  += ig
     elif type(d) is str or isinstance(d, pathlib.PurePath):
-        try:
-            p = Path(d)
-        except:
-            # This actually doesn't occur I think; Path() can pretty much convert any string into a Path
-            # object (which is equivalent to saying it doesn't have any restrictions for filenames).
-            ignored += 1
+        p = cached_replacement(to_replace, CompiledReplacements.replace_id_path, d)
+        if p is not None:
+            modified += 1
+            d = p
         else:
-            found = False
-
-            src, dst = "", ""
-
-            if set(p.stem).issubset(set("0123456789abcdef-")):
-                dst = to_replace.get(p.stem, "")
-                if dst:
-                    found = True
-                    p = p.with_stem(dst)
-
-            if not found:
-                for part in p.parts[:-1]:
-                    # Check if it can actually be an ID. If so, look it up (which is expensive).
-                    if set(part).issubset(set("0123456789abcdef-")):
-                        src = part
-                        dst = to_replace.get(part, "")
-                        if dst:
-                            break
-                if dst:
-                    found = True
-                    q = Path()
-                    # Find folder as path object that needs to be changed
-                    q = p
-                    while p.name != src:
-                        p = p.parent
-                    # q becomes the part relative to the now determined p part (with p.stem = id)
-                    q = q.relative_to(p)
-                    p = p.with_name(dst)
-
-                    # Check if the parent folder starts with byte(s) from the id
-                    if src.startswith(p.parent.name):
-                        # If so, move the already replaced part from p to q
-                        q = p.name / q
-                        p = p.parent
-                        # Replace required number of bytes
-                        p = p.with_name(dst[:len(p.name)])
-
-                    # Merge q and p back together
-                    p = p / q
-            if found:
-                modified += 1
-                # I guess 99% of the users won't migrate _to_ windows but the script could generate
-                # \ paths anyways.
-                # p.as_posix() makes sure that we always get a string with "/". Otherwise, on windows,
-                # str(p) would automatically return "\" paths.
-                d = p.as_posix().replace("/", to_replace["target_path_slash"])
-            else:
-                ignored += 1
-                # Unlike recursive_root_path_replacer, there is no need to warn the user about
-                # potential paths that haven't been altered. In case you suspect that something is
-                # overlooked, check out jellyfin_id_scanner.py.
-                # ignored is purely maintained for signature compatibility with recursive_root_path_replacer.
+            ignored += 1
+            # Unlike recursive_root_path_replacer, there is no need to warn the user about
+            # potential paths that haven't been altered. In case you suspect that something is
+            # overlooked, check out jellyfin_id_scanner.py.
+            # ignored is purely maintained for signature compatibility with recursive_root_path_replacer.
     return d, modified, ignored
 
 
+# The following functions compute the updated value of a single database column value.
+# They return the new value (the original one if nothing changed) as well as how many items
+# have been modified or ignored.
+def replace_json_value(data, replace_dict, replace_func):
+    if not data:
+        # There are numerous rows that have empty columns which would result in an error
+        # from json.loads. Just skip them
+        return data, 0, 0
+    if type(data) is not str:
+        return replace_decoded_json_value(data, replace_dict, replace_func)
+    new_data, modified, ignored = replace_json_strings(data, replace_dict, replace_func)
+    if json_verify_interval and next(json_verify_counter) % json_verify_interval == 0:
+        expected, mo, ig = replace_decoded_json_value(data, replace_dict, replace_func)
+        if (mo, ig) != (modified, ignored) or json.loads(expected) != json.loads(new_data):
+            print_log(f"JSON verification failed. Original: {data}  Expected: {expected}  Got: {new_data}",
+                      level=logging.WARNING)
+            return expected, mo, ig
+    return new_data, modified, ignored
+
+
+# String literals within a JSON document. The second group is set if it's the key of an object.
+json_string_literal = re.compile(r'"((?:[^"\\]|\\.)*)"(\s*:)?')
+json_verify_counter = count()
+
+
+# Applies replace_func to all the strings of a JSON document (except for the keys of objects,
+# just like the replacer functions do with dicts) without decoding the document. Only the
+# strings that actually change are encoded again and replaced within the JSON text; everything
+# else is left as it is.
+def replace_json_strings(data: str, replace_dict, replace_func):
+    modified, ignored = 0, 0
+    parts = []
+    end = 0
+    for m in json_string_literal.finditer(data):
+        if m.group(2):
+            continue
+        s = m.group(1)
+        if "\\" in s:
+            # Only strings with escape sequences need to be decoded.
+            s = json.loads(data[m.start():m.end(1) + 1])
+        new_s, mo, ig = replace_func(s, replace_dict)
+        modified += mo
+        ignored  += ig
+        if mo and new_s != s:
+            parts.append(data[end:m.start()])
+            parts.append(json.dumps(new_s))
+            end = m.end(1) + 1
+    if not parts:
+        return data, modified, ignored
+    parts.append(data[end:])
+    return "".join(parts), modified, ignored
+
+
+# Same as replace_json_value but decodes the whole JSON document, lets replace_func process the
+# resulting objects and encodes them again.
+def replace_decoded_json_value(data, replace_dict, replace_func):
+    new_data, modified, ignored = replace_func(json.loads(data), replace_dict)
+    # No need to serialize the data again if nothing has been replaced.
+    if modified:
+        new_data = json.dumps(new_data)
+        if new_data != data:
+            return new_data, modified, ignored
+    return data, modified, ignored
+
+
+def replace_path_value(path, replace_dict, replace_func):
+    # One could also skip the empty objects here, but recursive_path_replacer handles them
+    # just fine (leaves them untouched).
+    return replace_func(path, replace_dict)
+
+
+def replace_jf_images_value(imgs, replace_dict, replace_func):
+    # Jellyfin Image Metadata. Some DB entries look like this:
+    #     %MetadataPath%\library\71\71d037e6e74015a5a6231ce1b7912acf\poster.jpg*637693022742223153*Primary*198*198*eJC5#hK#Dj9GR/V@j]xuX8NG0x+xgN%MxaX7spNGnitQ$kK0wyV@Rj # noqa
+    # Yeah. That's a path and some other data within the same string, separated by *. More specifically:
+    #     path * last modified date * image type * width * height * blur hash
+    # where width, height, blur hash are apparently optional.
+    # In theory, the * could occur as normal character within regular paths but it's unlikely.
+    # Oh, and did I mention that such strings can contain multiple of these structures separated by a | ?
+    # Source (Jellyfin Server 10.7.7): DeserializeImages, AppendItemImageInfo:
+    # https://github.com/jellyfin/jellyfin/blob/045761605531f98c55f379ac9eb5b5b6004ef670/Emby.Server.Implementations/Data/SqliteItemRepository.cs#L1118 # noqa
+    modified, ignored = 0, 0
+    if not imgs:
+        return imgs, modified, ignored
+    new_imgs = imgs.split("|")
+    for j, img_properties in enumerate(new_imgs):
+        if not img_properties:
+            continue
+        img_properties = img_properties.split("*")
+        # path = first property
+        img_properties[0], mo, ig = replace_func(img_properties[0], replace_dict)
+        new_imgs[j] = "*".join(img_properties)
+        modified += mo
+        ignored  += ig
+    new_imgs = "|".join(new_imgs)
+    if new_imgs != imgs:
+        return new_imgs, modified, ignored
+    return imgs, modified, ignored
+
+
+# Computes the updated values of a single database row.
+# row contains the values of the json columns, followed by the path columns and the
+# jf_image columns (see update_db_table for details).
+# Returns a dict with the structure {column_name: updated_data} containing only the
+# columns that actually changed, as well as how many items have been modified or ignored.
+def get_updated_columns(
+        row,
+        replace_dict,
+        replace_func,
+        path_columns=(),
+        json_columns=(),
+        jf_image_columns=(),
+):
+    modified, ignored = 0, 0
+
+    # result has the structure {column_name: updated_data} which makes it very easy to build
+    # the update query later on.
+    result = dict()
+
+    # It's important to note that the row contains the columns _in the order of the query
+    # string_. Therefore, we can separate json, path and jf_image entries like this.
+    columns = [(c, replace_json_value) for c in json_columns] + \
+              [(c, replace_path_value) for c in path_columns] + \
+              [(c, replace_jf_images_value) for c in jf_image_columns]
+    for (column, replace_value), data in zip(columns, row):
+        new_data, mo, ig = replace_value(data, replace_dict, replace_func)
+        modified += mo
+        ignored  += ig
+        if new_data != data:
+            result[column] = new_data
+
+    return result, modified, ignored
+
+
+# Computes the updated values of a batch of database rows (see get_updated_columns).
+# Each row is expected to start with its rowid. kwargs contains the remaining arguments
+# for get_updated_columns.
+# Returns a list with (rowid, result) tuples for all rows that have been changed, as well
+# as how many items have been modified or ignored.
+def get_updated_rows(rows, kwargs):
+    results = []
+    modified, ignored = 0, 0
+    for rowid, *row in rows:
+        if not rowid:
+            continue
+        result, mo, ig = get_updated_columns(row, **kwargs)
+        modified += mo
+        ignored  += ig
+        # It can happen that no changes are made at all. In this case there's no need to
+        # touch the row.
+        if result:
+            results.append((rowid, result))
+    return results, modified, ignored
+
+
+# The worker processes of update_db_table get the arguments that are the same for all rows
+# only once when they're started (the replacement dict can be huge). They're stored here.
+db_worker_kwargs = dict()
+
+
+def init_db_worker(kwargs):
+    global db_worker_kwargs, log_buffered
+    db_worker_kwargs = kwargs
+    log_buffered = False
+
+
+# Additionally returns the statistics of the worker's replacement cache for this batch of rows
+# so that the main process can include them in its own statistics.
+def get_updated_rows_worker(rows):
+    hits, misses = replacement_cache_stats["hits"], replacement_cache_stats["misses"]
+    result = get_updated_rows(rows, db_worker_kwargs)
+    return result, replacement_cache_stats["hits"] - hits, replacement_cache_stats["misses"] - misses
+
+
+# Writes the results from get_updated_rows back to the table.
+def write_updated_rows(cur, table, results):
+    # Rows are grouped by the columns that have been changed. Each group can then be
+    # written back with a single executemany.
+    updates = dict()
+    for rowid, result in results:
+        updates.setdefault(tuple(result.keys()), []).append(tuple(result.values()) + (rowid,))
+
+    for keys, args in updates.items():
+        # Construct a comma separated list of the columns that need to be updated:
+        #     `columnname` = ?
+        # While the new values are all strings, the question mark avoids any issues with handling
+        # backslashes etc. The library offers an easy, built-in way to do it so there's no reason
+        # to mess with it myself.
+        # The query has a question mark for each updated column plus one for the rowid to identify
+        # the correct row.
+        keys = ", ".join([f"`{k}` = ?" for k in keys])
+        query = f"UPDATE `{table}` SET {keys} WHERE `rowid` = ?"
+        try:
+            cur.executemany(query, args)
+        except Exception as e:
+            # This was mainly for debugging purposes and shouldn't be reached anymore. Doesn't
+            # hurt to have it though.
+            print_log("Error:", e, level=logging.ERROR)
+            print_log("Query:", query, level=logging.ERROR)
+            print_log(e, level=logging.ERROR)
+            exit()
+        else:
+            if cur.rowcount < len(args):
+                # This was mainly for debugging purposes and shouldn't be reached anymore.
+                # Doesn't hurt to have it though.
+                print_log(f"Only {cur.rowcount} of {len(args)} rows modified!", level=logging.ERROR)
+                print_log("Query:", query, level=logging.ERROR)
+                exit()
+
+
+# Secondary indexes slow down bulk updates a lot since every modified row has to be updated
+# in all indexes of its table. It's way faster to drop them and to rebuild them once at the
+# end. Only non-unique indexes created by CREATE INDEX are dropped; unique indexes are kept
+# so the unique constraints are still enforced (and found by resolve_id_collisions).
+# The dropped indexes are saved in the journal in case the migration is interrupted before
+# they're recreated.
+def drop_secondary_indexes(file, tables) -> list:
+    key = f"dropped_indexes {file}"
+    dropped = json.loads(journal.get_state(key, "[]"))
+    con = connect_db(file, profile=db_profile)
+    indexes = []
+    for table in tables:
+        for _, name, unique, origin, _ in con.execute(f"PRAGMA index_list(`{table}`)").fetchall():
+            if origin == "c" and not unique:
+                sql, = next(con.execute("SELECT `sql` FROM `sqlite_master` WHERE `type` = 'index' AND `name` = ?",
+                                        (name,)))
+                indexes.append((name, sql))
+    dropped.extend(indexes)
+    journal.set_state(key, json.dumps(dropped))
+    for name, sql in indexes:
+        con.execute(f"DROP INDEX `{name}`")
+    con.commit()
+    con.close()
+    if indexes:
+        print_log(f"Dropped {len(indexes)} indexes; they're recreated once the tables have been updated.")
+    return dropped
+
+
+def restore_secondary_indexes(file, dropped: list):
+    if not dropped:
+        return
+    print_log(f"Recreating {len(dropped)} indexes...")
+    con = connect_db(file, profile=db_profile)
+    existing = {name for name, in con.execute("SELECT `name` FROM `sqlite_master` WHERE `type` = 'index'")}
+    for name, sql in dropped:
+        if name not in existing:
+            con.execute(sql)
+            existing.add(name)
+    con.commit()
+    con.close()
+    journal.set_state(f"dropped_indexes {file}", "[]")
+
+
 def update_db_table(
         file,
         replace_dict,
@@ -625,7 +1265,7 @@ def update_db_table(
     rows_count, modified, ignored = 0, 0, 0
 
     # Initialize sqlite3 objects
-    con = sqlite3.connect(file)
+    con = connect_db(file, profile=db_profile)
     cur = con.cursor()
 
     # If only one item has been specified, convert it to a list with one item instead.
@@ -635,167 +1275,640 @@ def update_db_table(
         json_columns = [json_columns]
     if type(jf_image_columns) not in (tuple, set, list):
         jf_image_columns = [jf_image_columns]
+    path_columns, json_columns, jf_image_columns = list(path_columns), list(json_columns), list(jf_image_columns)
+
+    kwargs = {
+        "replace_dict": replace_dict,
+        "replace_func": replace_func,
+        "path_columns": path_columns,
+        "json_columns": json_columns,
+        "jf_image_columns": jf_image_columns,
+    }
+
+    rows_count = next(cur.execute(f"SELECT COUNT(*) FROM `{table}`"))[0]
+
+    # Columns with many duplicate values are updated via their distinct values first and
+    # then left out of the row by row processing below. The json columns (f.ex. the item data)
+    # are practically never duplicated; counting their distinct values would be expensive.
+    # For the others, the duplicates are estimated from a sample of db_batch_size rows.
+    sample_size = min(rows_count, db_batch_size)
+    for columns, replace_value in (
+            (path_columns, replace_path_value),
+            (jf_image_columns, replace_jf_images_value),
+    ):
+        for column in columns[:]:
+            if not db_distinct_ratio or not sample_size:
+                break
+            distinct_count = next(cur.execute(
+                f"SELECT COUNT(DISTINCT `value` COLLATE BINARY) FROM "
+                f"(SELECT `{column}` AS `value` FROM `{table}` LIMIT {sample_size})"
+            ))[0]
+            if distinct_count * db_distinct_ratio > sample_size:
+                continue
+            print_log(f"Column {column} has {distinct_count} distinct values in a sample of {sample_size} rows, "
+                      f"updating only the distinct values.")
+            mo, ig = update_db_column_distinct(con, table, column, replace_value, replace_dict, replace_func)
+            modified += mo
+            ignored  += ig
+            columns.remove(column)
+    if not preview:
+        con.commit()
+
+    # Processing the rows (especially the json columns) is CPU bound. Big tables are therefore
+    # split into batches that are processed in parallel by a pool of worker processes (see
+    # update_db_table_in_batches). Everything else is done by SQLite itself, calling the
+    # replacement functions directly (see update_db_table_in_sql).
+    workers = db_workers or os.cpu_count() or 1
+    if not json_columns + path_columns + jf_image_columns:
+        # All columns have already been updated.
+        pass
+    elif workers > 1 and rows_count > db_batch_size:
+        mo, ig = update_db_table_in_batches(con, table, kwargs, rows_count, workers, preview)
+        modified += mo
+        ignored  += ig
+    else:
+        mo, ig = update_db_table_in_sql(con, table, rows_count, preview=preview, **kwargs)
+        modified += mo
+        ignored  += ig
+
+    print_log(f"Processed {rows_count} rows in table {table}. ")
+    print_log(f"{modified} paths have been modified.")
+
+    con.close()
+
+
+# Updates a single column by computing the new value of each distinct value only once.
+# The changed values are collected in a temporary table (old value -> new value) which is
+# then applied to the whole column with a single query. replace_value is one of the
+# replace_*_value functions matching the kind of column.
+# Returns how many items have been modified or ignored, counted per row like the regular
+# update does.
+def update_db_column_distinct(con, table, column, replace_value, replace_dict, replace_func):
+    modified, ignored = 0, 0
+    cur = con.cursor()
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS `distinct_map` (`old` PRIMARY KEY, `new`)")
+    cur.execute("DELETE FROM temp.`distinct_map`")
+
+    changes = []
+    values = cur.execute(
+        f"SELECT `{column}`, COUNT(*) FROM `{table}` WHERE `{column}` IS NOT NULL GROUP BY `{column}` COLLATE BINARY"
+    ).fetchall()
+    for value, n in values:
+        new_value, mo, ig = replace_value(value, replace_dict, replace_func)
+        modified += mo * n
+        ignored  += ig * n
+        if new_value != value:
+            changes.append((value, new_value))
+    cur.executemany("INSERT INTO temp.`distinct_map` VALUES (?, ?)", changes)
+
+    # COLLATE BINARY: exact matches only, even if the column is declared case insensitive.
+    match = f"`{column}` COLLATE BINARY IN (SELECT `old` FROM temp.`distinct_map`)"
+    cur.execute(
+        f"UPDATE `{table}` SET `{column}` = ("
+        f"SELECT `new` FROM temp.`distinct_map` WHERE `old` = `{table}`.`{column}` COLLATE BINARY"
+        f") WHERE {match}"
+    )
+    cur.execute("DROP TABLE temp.`distinct_map`")
+    return modified, ignored
+
+
+# Names of the SQL functions used by update_db_table_in_sql for the path columns.
+sql_path_functions = {
+    recursive_root_path_replacer: "jf_path",
+    recursive_id_path_replacer: "jf_id_path",
+}
+
+
+# Updates the columns of a table with a single query. The replacement functions are registered
+# as SQL functions:
+#   * jf_path / jf_id_path for path columns (root or ID replacements, see sql_path_functions),
+#   * jf_json for json columns and
+#   * jf_images for jf_image columns.
+# Each of them has a companion function with the suffix "_changes" that returns whether the
+# value changes at all. Both take the value and the position of the column in the query, f.ex.:
+#     UPDATE `table` SET `c` = jf_path(`c`, 0) WHERE jf_path_changes(`c`, 0) > 0
+# This avoids transferring every row from SQLite to python and back.
+# The _changes functions compute the new values, which are then reused by the other function
+# (SQLite computes the new values of a row right after checking its WHERE clause). They're
+# also the ones counting the modified and ignored items. Since they're added in the WHERE
+# clause (instead of or-ed), SQLite calls each of them exactly once per row.
+# Like update_db_table_in_batches, the table is updated in ranges of db_batch_size rows
+# (by rowid) and the changes are committed after each range.
+def update_db_table_in_sql(
+        con,
+        table,
+        rows_count,
+        replace_dict,
+        replace_func,
+        path_columns,
+        json_columns,
+        jf_image_columns,
+        preview=False,
+):
+    stats = {"modified": 0, "ignored": 0, "rows": 0}
+    # Column position -> (value, new value) of the last _changes call.
+    last_results = dict()
+
+    def register(name, replace_value):
+        def changes(value, i):
+            new_value, mo, ig = replace_value(value, replace_dict, replace_func)
+            stats["modified"] += mo
+            stats["ignored"]  += ig
+            if i == 0:
+                stats["rows"] += 1
+            last_results[i] = (value, new_value)
+            return new_value != value
+
+        def new(value, i):
+            last = last_results.get(i)
+            if last is not None and last[0] == value:
+                return last[1]
+            # Shouldn't happen, but SQLite is free to evaluate the query in another order.
+            return replace_value(value, replace_dict, replace_func)[0]
+
+        # Not deterministic: SQLite could otherwise reuse the results of earlier calls, which
+        # breaks the pairing of both functions via last_results (and the stats).
+        con.create_function(name, 2, new)
+        con.create_function(name + "_changes", 2, changes)
+
+    register("jf_json", replace_json_value)
+    register(sql_path_functions[replace_func], replace_path_value)
+    register("jf_images", replace_jf_images_value)
+
+    # Print the progress every second. SQLite calls this regularly while executing the query.
+    t = time()
 
-    # This index will be used to separate the json from the path columns in the cur.execute
-    # result further below.
-    json_stop = len(json_columns)
-    path_stop = json_stop + len(path_columns)
+    def progress():
+        nonlocal t
+        now = time()
+        if now - t > 1:
+            print_log(f"Progress: {stats['rows']} / {rows_count} rows")
+            t = now
+
+    con.set_progress_handler(progress, 100000)
+
+    # It's important to note that the json columns come first, followed by the path columns
+    # and the jf_image columns (see get_updated_columns).
+    columns = [(c, "jf_json") for c in json_columns] + \
+              [(c, sql_path_functions[replace_func]) for c in path_columns] + \
+              [(c, "jf_images") for c in jf_image_columns]
+    new_values = ", ".join(f"`{c}` = {f}(`{c}`, {i})" for i, (c, f) in enumerate(columns))
+    changes = " + ".join(f"{f}_changes(`{c}`, {i})" for i, (c, f) in enumerate(columns))
+    # Smallest possible rowid (64 bit signed integer), see update_db_table_in_batches.
+    last_rowid = -2**63
+    while True:
+        end_rowid = next(con.execute(f"SELECT MAX(`rowid`) FROM (SELECT `rowid` FROM `{table}` WHERE `rowid` > ? "
+                                     f"ORDER BY `rowid` LIMIT ?)", (last_rowid, db_batch_size)))[0]
+        if end_rowid is None:
+            break
+        con.execute(f"UPDATE `{table}` SET {new_values} WHERE `rowid` > ? AND `rowid` <= ? AND {changes} > 0",
+                    (last_rowid, end_rowid))
+        last_rowid = end_rowid
+        # Once again, this came from the development and is not required anymore, especially
+        # since by default the script is working on copies of the original files.
+        if not preview:
+            con.commit()
+
+    con.set_progress_handler(None, 0)
+    return stats["modified"], stats["ignored"]
+
+
+# Updates the columns of a big table in batches that are processed in parallel by a pool of
+# worker processes (see get_updated_rows). The workers only compute the new values; all
+# database accesses are done here, by the main process.
+def update_db_table_in_batches(con, table, kwargs, rows_count, workers, preview):
+    modified, ignored = 0, 0
+    cur = con.cursor()
 
     # For the sql query the desired row names should be enclosed in ` ` and comma separated.
     # It's important to note that the json columns come first, followed by the path columns
-    columns = ", ".join([f"`{e}`" for e in list(json_columns) + list(path_columns)] + list(jf_image_columns))
+    # and the jf_image columns (see get_updated_columns).
+    columns = kwargs["json_columns"] + kwargs["path_columns"] + kwargs["jf_image_columns"]
+    columns = ", ".join([f"`{e}`" for e in columns])
 
-    # Query the unique IDs of all rows. Note: we cannot iterate over the rows using
+    # We cannot iterate over the rows using
     #     for row in cur.execute(get rows)
-    # because the rows are modified by the loop, which breaks that iterator. Hence
-    # the solution with reading all row ids and iterating over them instead.
-    # Note: The cur.execute yields tuples with all the columns queried. Which means that
-    # the array below actually contains _tuples_ with the id. This is however desirable
-    # in our case; see below where id is used.
-    todo = [rowid for rowid in cur.execute(f"SELECT `rowid` FROM `{table}`") if rowid[0]]
-    rows_count = len(todo)
+    # because the rows are modified by the loop, which breaks that iterator. Instead, the table
+    # is read in batches ordered by rowid. Each batch is fetched completely, processed and
+    # written back. Each batch only contains rows with a greater rowid than all the batches
+    # before, hence writing back a batch never interferes with reading the next one.
+    query = f"SELECT `rowid`, {columns} FROM `{table}` WHERE `rowid` > ? ORDER BY `rowid` LIMIT ?"
+
+    pool = Pool(workers, initializer=init_db_worker, initargs=(kwargs,))
+    print_log(f"Processing table with {workers} worker processes.")
+
+    # Batches that are being processed by the pool. To keep the memory usage bounded, only a
+    # couple of batches per worker are read ahead. The results are written back in the same
+    # order the batches have been read.
+    pending = deque()
+    # Smallest possible rowid (64 bit signed integer). Jellyfin doesn't use negative rowids anyway.
+    last_rowid = -2**63
+    progress = 0
     t = time()
-    for progress, id in enumerate(todo):
+    rows = True
+    while rows or pending:
+        rows = cur.execute(query, (last_rowid, db_batch_size)).fetchall() if rows else []
+        if rows:
+            last_rowid = rows[-1][0]
+            pending.append((len(rows), pool.apply_async(get_updated_rows_worker, (rows,))))
+            if len(pending) < 2 * workers:
+                continue
+        if not pending:
+            break
+
+        batch_size, result = pending.popleft()
+        (results, mo, ig), hits, misses = result.get()
+        replacement_cache_stats["hits"]   += hits
+        replacement_cache_stats["misses"] += misses
+        modified += mo
+        ignored  += ig
+        write_updated_rows(cur, table, results)
+
+        # Once again, this came from the development and is not required anymore, especially
+        # since by default the script is working on copies of the original files.
+        if not preview:
+            # Write the updated batch back to the file.
+            con.commit()
+
         # Print the progress every second. Note: this is the only usage of the "progress" variable.
+        progress += batch_size
         now = time()
         if now - t > 1:
             print_log(f"Progress: {progress} / {rows_count} rows")
             t = now
 
-        # Query the columns we want to check/modify of the current row (selected by id).
-        # Since the id is a binary object, it's not directly included in the f-string.
-        # The cur.execute expects as second argument a _tuple_ with as many elements as
-        # there are ? characters in the query string. This is the reason why we kept the
-        # IDs as tuple. The only other place where this id is used is in the update query
-        # at the end of the loop which requires - just like here - a tuple.
-        row = [r for r in cur.execute(f"SELECT {columns} FROM `{table}` WHERE `rowid` = ?", id)]
-        # This _should_ not occur, but I think I have seen it happen rarely. Safe is safe.
-        if len(row) != 1:
-            print_log(f"Error with rowid {id}! Resulted in {len(row)} rows instead of 1. Skipping.")
-            continue
-        # cur.execute returns a 2D tuple, containing all rows matching the query, and then
-        # in each row the selected columns. We only selected a single row, hence row[0] is
-        # all we care about (and all there is, see error handling above).
-        # Secondly we want row to be modifiable, hence the conversion to a list.
-        # list(row[0]) would btw return a list with 1 element: the tuple of the columns.
-        row = [e for e in row[0]]
-
-        # result has the structure {column_name: updated_data} which makes it very easy to build
-        # the update query at the end.
-        result = dict()
-
-        # It's important to note that the tuple from cur.execute contains the columns _in the order
-        # of the query string_. Therefore, we can separate json and path entries like this.
-        jsons = row[:json_stop]
-        paths = row[json_stop:path_stop]
-        jf_imgs = row[path_stop:]
-        for i, data in enumerate(jsons):
-            if data:
-                # There are numerous rows that have empty columns which would result in an error
-                # from json.loads. Just skip them
-                data = json.loads(data)
-                data, mo, ig = replace_func(data, replace_dict)
-                modified += mo
-                ignored  += ig
-                result[json_columns[i]] = json.dumps(data)
-        for i, path in enumerate(paths):
-            # One could also skip the empty objects here, but recursive_path_replacer handles them
-            # just fine (leaves them untouched).
-            path, mo, ig = replace_func(path, replace_dict)
-            modified += mo
-            ignored  += ig
-            result[path_columns[i]] = path
-        for i, imgs in enumerate(jf_imgs):
-            # Jellyfin Image Metadata. Some DB entries look like this:
-            #     %MetadataPath%\library\71\71d037e6e74015a5a6231ce1b7912acf\poster.jpg*637693022742223153*Primary*198*198*eJC5#hK#Dj9GR/V@j]xuX8NG0x+xgN%MxaX7spNGnitQ$kK0wyV@Rj # noqa
-            # Yeah. That's a path and some other data within the same string, separated by *. More specifically:
-            #     path * last modified date * image type * width * height * blur hash
-            # where width, height, blur hash are apparently optional.
-            # In theory, the * could occur as normal character within regular paths but it's unlikely.
-            # Oh, and did I mention that such strings can contain multiple of these structures separated by a | ?
-            # Source (Jellyfin Server 10.7.7): DeserializeImages, AppendItemImageInfo:
-            # https://github.com/jellyfin/jellyfin/blob/045761605531f98c55f379ac9eb5b5b6004ef670/Emby.Server.Implementations/Data/SqliteItemRepository.cs#L1118 # noqa
-            if not imgs:
-                continue
-            imgs = imgs.split("|")
-            for j, img_properties in enumerate(imgs):
-                if not img_properties:
-                    continue
-                img_properties = img_properties.split("*")
-                # path = first property
-                img_properties[0], mo, ig = replace_func(img_properties[0], replace_dict)
-                imgs[j] = "*".join(img_properties)
-                modified += mo
-                ignored  += ig
-            imgs = "|".join(imgs)
-            result[jf_image_columns[i]] = imgs
-
-        # Similar to the initial query we construct a comma separated list of the columns, only this
-        # time we write
-        #     `columnname` = ?
-        # While the new values are all strings, the question mark avoids any issues with handling
-        # backslashes etc. The library offers an easy, built-in way to do it so there's no reason
-        # to mess with it myself.
-        # Note that this relies on result.keys() and result.values() returning the entries in the
-        # same order (which is guaranteed).
-        # Note: it can happen that no changes are made at all. In this case we can abort here and
-        #       go for the next job from the todo_list.
-        if not result:
-            continue
-        keys = ", ".join([f"`{k}` = ?" for k in result.keys()])
-        query = f"UPDATE `{table}` SET {keys} WHERE `rowid` = ?"
+    pool.close()
+    pool.join()
+    return modified, ignored
+
+
+# Returns whether a (metadata) file may contain anything that replace_func would replace
+# (see CompiledReplacements.may_match).
+def file_may_match(file: Path, replace_dict: dict, replace_func) -> bool:
+    replace_method = {
+        recursive_root_path_replacer: CompiledReplacements.replace_path,
+        recursive_id_path_replacer: CompiledReplacements.replace_id_path,
+    }.get(replace_func)
+    if replace_method is None:
+        return True
+    replace_dict = compile_replacements(replace_dict)
+    with open(file, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < file_mmap_size:
+            data = f.read()
+        else:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            # Only ASCII compatible encodings can be scanned like that (UTF-16 contains null bytes).
+            if b"\x00" in data[:1024]:
+                return True
+            return replace_dict.may_match(data, replace_method)
+        finally:
+            if size >= file_mmap_size:
+                data.close()
+
+
+# SAX handler used by update_xml. Everything is passed on to an XMLGenerator writing the new
+# file, except for the text of each element (the text before its first child, "el.text" in
+# ElementTree terms), which is processed by replace_func first. Only the text of the current
+# element is kept in memory; the rest of the document streams through.
+# If tags is given, only the text of these tags is processed (see xml_tag_index).
+# It's also the lexical handler of the parser (see update_xml), otherwise the comments would
+# get lost.
+class XmlRewriter(xml.sax.handler.ContentHandler):
+    def __init__(self, out: XMLGenerator, replace_dict: dict, replace_func, tags: set = None):
+        super().__init__()
+        self.out = out
+        self.replace_dict = replace_dict
+        self.replace_func = replace_func
+        self.tags = tags
+        # [tag, text processed] of the open elements.
+        self.stack = []
+        self.text = []
+        self.modified, self.ignored = 0, 0
+        # Whether the end tag of the root element has been written (see comment).
+        self.root_closed = False
+
+    # Writes the text collected since the last start/end tag.
+    def flush_text(self):
+        text = "".join(self.text) or None
+        self.text = []
+        if self.stack and not self.stack[-1][1]:
+            # The text of the current element.
+            self.stack[-1][1] = True
+            # Exclude a few tags known to contain no paths.
+            # biography, outline: These often contain lots of text (= slow to process) and generate
+            # false-positives for the missed path detection (see recursive_root_path_replacer)
+            tag = self.stack[-1][0]
+            if tag not in ("biography", "outline") and (self.tags is None or tag in self.tags):
+                text, mo, ig = self.replace_func(text, self.replace_dict)
+                self.modified += mo
+                self.ignored  += ig
+        # Otherwise it's the text after the end of a child element, which is left as it is.
+        if text:
+            self.out.characters(text)
+
+    def startElement(self, name, attrs):
+        self.flush_text()
+        self.out.startElement(name, attrs)
+        self.stack.append([name, False])
+
+    def endElement(self, name):
+        self.flush_text()
+        self.out.endElement(name)
+        self.stack.pop()
+        self.root_closed = not self.stack
+
+    def characters(self, content):
+        self.text.append(content)
+
+    def ignorableWhitespace(self, whitespace):
+        self.text.append(whitespace)
+
+    def processingInstruction(self, target, data):
+        self.flush_text()
+        self.out.processingInstruction(target, data)
+
+    # Lexical handler (see xml.sax.handler.property_lexical_handler). XMLGenerator has no method
+    # for comments; ignorableWhitespace writes the text as it is.
+    def comment(self, content):
+        self.flush_text()
+        comment = f"<!--{content}-->"
+        if not self.stack:
+            # Before or after the root element. The parser doesn't report the whitespace there;
+            # such comments are put on their own line.
+            comment = "\n" + comment if self.root_closed else comment + "\n"
+        self.out.ignorableWhitespace(comment)
+
+    # The CDATA sections are passed on as regular (escaped) text, the DTD isn't written at all.
+    def startCDATA(self):
+        pass
+
+    def endCDATA(self):
+        pass
+
+    def startDTD(self, name, public_id, system_id):
+        pass
+
+    def endDTD(self):
+        pass
+
+
+# Tags of each type of XML file (see get_xml_file_type) whose text may contain paths or IDs:
+# {file type: {tags}}. Filled by load_xml_tag_index if use_xml_tag_index is enabled.
+xml_tag_index = dict()
+
+
+# Returns the type of an XML file for the xml_tag_index. All NFO files have the same type; the
+# other XML files (f.ex. collection.xml, playlist.xml, system.xml, ...) are told apart by name.
+def get_xml_file_type(file: Path) -> str:
+    if file.suffix.lower() == ".nfo":
+        return ".nfo"
+    return file.name.lower()
+
+
+# Returns whether the text of an XML tag may be (or contain) a path or an ID.
+# Titles, plots, genres, ratings, ... don't.
+def may_be_path(text: str) -> bool:
+    return any(c in text for c in "/\\%:") or id_token.search(text) is not None
+
+
+# SAX handler collecting the tags of an XML file whose text may contain a path (see may_be_path).
+class XmlTagScanner(xml.sax.handler.ContentHandler):
+    def __init__(self, tags: set):
+        super().__init__()
+        self.tags = tags
+        self.stack = []
+        self.text = []
+
+    def startElement(self, name, attrs):
+        self.check_text()
+        self.stack.append(name)
+
+    def endElement(self, name):
+        self.check_text()
+        self.stack.pop()
+
+    def characters(self, content):
+        self.text.append(content)
+
+    # Only the text before the first child of an element matters (see XmlRewriter).
+    def check_text(self):
+        if self.text and self.stack and self.stack[-1] is not None:
+            if may_be_path("".join(self.text)):
+                self.tags.add(self.stack[-1])
+        if self.stack:
+            self.stack[-1] = None
+        self.text = []
+
+
+# Loads the xml_tag_index from xml_tag_index_file. If it doesn't exist yet, all XML and NFO
+# files in source_root are scanned for the tags that may contain paths and the result is saved.
+def load_xml_tag_index():
+    global xml_tag_index
+    if xml_tag_index_file.exists():
+        with open(xml_tag_index_file, "r", encoding="utf-8") as f:
+            xml_tag_index = {file_type: set(tags) for file_type, tags in json.load(f).items()}
+        print_log(f"Loaded XML tag index for {len(xml_tag_index)} file types.")
+        return
 
-        # The query has a question mark for each updated column plus one for the id to identify
-        # the correct row.
-        args = tuple(result.values()) + id
+    print_log("Scanning XML files for tags containing paths... ")
+    index = dict()
+    for file in get_source_index().files:
+        file = source_root / file
+        if file.suffix.lower() not in (".xml", ".nfo"):
+            continue
+        tags = set()
         try:
-            cur.execute(query, args)
-        except Exception as e:
-            # This was mainly for debugging purposes and shouldn't be reached anymore. Doesn't
-            # hurt to have it though.
-            print_log("Error:", e)
-            print_log("Query:", query)
-            print_log("Args: ", args)
-            print_log(e)
-            exit()
-        else:
-            if cur.rowcount < 1:
-                # This was mainly for debugging purposes and shouldn't be reached anymore.
-                # Doesn't hurt to have it though.
-                print_log("No data modified!")
-                print_log("Query:", query)
-                print_log("Args: ", args)
-                exit()
-    print_log(f"Processed {rows_count} rows in table {table}. ")
-    print_log(f"{modified} paths have been modified.")
+            xml.sax.parse(str(file), XmlTagScanner(tags))
+        except (xml.sax.SAXException, OSError) as e:
+            # Broken files would fail later on anyway. Don't let them decide about the other files.
+            print_log(f"Can't scan {file}: {e}", level=logging.WARNING)
+            continue
+        index.setdefault(get_xml_file_type(file), set()).update(tags)
+    xml_tag_index = index
+    print_log(f"Found {sum(len(tags) for tags in index.values())} tags in {len(index)} file types.")
 
-    # Once again, this came from the development and is not required anymore, especially
-    # since by default the script is working on copies of the original files.
-    if not preview:
-        # Write the updated database back to the file.
-        con.commit()
-    con.close()
+    xml_tag_index_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(xml_tag_index_file, "w", encoding="utf-8") as f:
+        json.dump({file_type: sorted(tags) for file_type, tags in index.items()}, f, indent=2)
 
 
 # Walks through an XML file and checks *all* entries.
 # WARNING: The documentation of this parser explicitly mentions that it's not hardened against
 # known XML vulnerabilities. It is NOT suitable for unknown/unsafe XML files. Shouldn't be an
 # issue here though.
+# The file is streamed through XmlRewriter into a temporary file which then replaces the
+# original one. The XML declaration (and encoding), the comments and the final newline of the
+# original file are kept.
 def update_xml(file: Path, replace_dict: dict, replace_func) -> None:
-    modified, ignored = 0, 0
-    tree = ET.parse(file)
-    root = tree.getroot()
-    for el in root.iter():
-        # Exclude a few tags known to contain no paths.
-        # biography, outline: These often contain lots of text (= slow to process) and generate
-        # false-positives for the missed path detection (see recursive_root_path_replacer)
-        if el.tag in ("biography", "outline"):
-            continue
-        el.text, mo, ig = replace_func(el.text, replace_dict)
-        modified += mo
-        ignored  += ig
-    print_log(f"Processed {ignored + modified} elements. {modified} paths have been modified.")
-    tree.write(file)  # , encoding="utf-8")
+    with open(file, "rb") as f:
+        head = f.read(1024)
+        f.seek(max(os.fstat(f.fileno()).st_size - 16, 0))
+        tail = f.read()
+    declaration = re.match(rb"(?:\xef\xbb\xbf)?<\?xml[^>]*\?>", head)
+    encoding = re.search(rb"encoding\s*=\s*[\"']([A-Za-z0-9._-]+)", declaration.group()) if declaration else None
+    encoding = encoding.group(1).decode("ascii") if encoding else "utf-8"
+
+    tmp = file.with_name(file.name + ".jf-migrator-tmp")
+    try:
+        with open(tmp, "wb") as f:
+            if declaration:
+                f.write(declaration.group() + b"\n")
+            out = XMLGenerator(f, encoding=encoding, short_empty_elements=True)
+            rewriter = XmlRewriter(out, replace_dict, replace_func, xml_tag_index.get(get_xml_file_type(file)))
+            parser = xml.sax.make_parser()
+            parser.setContentHandler(rewriter)
+            parser.setProperty(xml.sax.handler.property_lexical_handler, rewriter)
+            parser.parse(str(file))
+            if b"\n" in tail[tail.rfind(b">") + 1:]:
+                out.ignorableWhitespace("\n")
+            out.endDocument()
+        tmp.replace(file)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    print_log(f"Processed {rewriter.ignored + rewriter.modified} elements. {rewriter.modified} paths have been modified.",
+              level=logging.DEBUG)
+
+
+# Copy engine used by get_target. Files are copied by a pool of threads; the futures of
+# pending copies are stored by their target path. wait_for_copies must be called at the
+# end of each phase (done by process_files).
+copy_executor = None
+copy_futures = dict()
+copy_stats = {"files": 0, "bytes": 0, "start": 0, "linked": 0, "fallbacks": dict()}
+copy_stats_lock = threading.Lock()
+# Target folders that are known to exist. Saves a lot of mkdir calls for folders with
+# many files.
+created_dirs = set()
+
+
+# Linux ioctl request number for creating a reflink (see ioctl_ficlone(2)).
+FICLONE = 0x40049409
+link_modes = ("copy", "hardlink", "reflink", "symlink")
+
+
+# Creates target as hard link, reflink or symbolic link of source. Falls back to a regular
+# copy if that's not possible.
+def link_file(source: Path, target: Path, mode: str) -> int:
+    # Never write through an existing link (f.ex. from a previous run) into the source file.
+    try:
+        os.unlink(target)
+    except FileNotFoundError:
+        pass
+    try:
+        if mode == "hardlink":
+            os.link(source, target)
+        elif mode == "symlink":
+            os.symlink(os.path.abspath(source), target)
+        elif mode == "reflink":
+            if fcntl is None:
+                raise OSError("reflinks are not supported on this system")
+            with open(source, "rb") as fsrc, open(target, "wb") as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            shutil.copymode(source, target)
+    except OSError:
+        # Different drives, file system without link support, missing permissions, ...
+        with copy_stats_lock:
+            copy_stats["fallbacks"][mode] = copy_stats["fallbacks"].get(mode, 0) + 1
+        return copy_file(source, target)
+    with copy_stats_lock:
+        copy_stats["linked"] += 1
+    return 0
+
+
+# Same as shutil.copy (content and permission bits) but lets the kernel copy the data
+# directly between the files if possible. On file systems supporting it (btrfs, XFS, NFS,
+# SMB, ...) copy_file_range even does server-side copies or reflinks.
+# If that's not available, shutil.copyfile still uses sendfile/fcopyfile where possible.
+def copy_file(source: Path, target: Path) -> int:
+    # Don't write into the source file if target is a link to it (see link_mode).
+    if os.path.islink(target) or (target.exists() and target.stat().st_nlink > 1):
+        os.unlink(target)
+    copied = False
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(source, "rb") as fsrc, open(target, "wb") as fdst:
+                total = 0
+                while True:
+                    n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), 2**30)
+                    if not n:
+                        break
+                    total += n
+                # Some (FUSE, network, overlay, ...) file systems report 0 bytes copied for files
+                # they can't handle. Only trust the result if the whole file has been copied.
+                copied = total == os.fstat(fsrc.fileno()).st_size
+        except OSError:
+            # Not supported by this (combination of) file system(s). Any partially written
+            # target is truncated by copyfile.
+            pass
+    if not copied:
+        shutil.copyfile(source, target)
+    shutil.copymode(source, target)
+    size = os.path.getsize(target)
+    with copy_stats_lock:
+        copy_stats["files"] += 1
+        copy_stats["bytes"] += size
+    return size
+
+
+# Turns a hard link or symbolic link created by link_file into a real copy of the file.
+# Must be called before modifying a file.
+def break_link(file: Path):
+    st = os.lstat(file)
+    if stat.S_ISLNK(st.st_mode) or st.st_nlink > 1:
+        tmp = file.with_name(file.name + ".jf-migrator-tmp")
+        shutil.copy2(file, tmp)
+        os.replace(tmp, file)
+
+
+# Queues a copy (or link, see link_mode) from source to target and returns its future.
+def start_copy(source: Path, target: Path, mode: str = "copy"):
+    global copy_executor
+    if mode not in link_modes:
+        raise ValueError(f"Unknown link_mode {mode}, must be one of {link_modes}.")
+    if copy_executor is None:
+        copy_executor = ThreadPoolExecutor(max_workers=max(1, copy_workers))
+        copy_stats.update(files=0, bytes=0, start=time(), linked=0, fallbacks=dict())
+    # If the same target is still being copied from another source, the later copy
+    # has to win (like it would if the files were copied one by one).
+    pending = copy_futures.pop(target, None)
+    if pending is not None:
+        pending.result()
+    if target.parent not in created_dirs:
+        target.parent.mkdir(parents=True, exist_ok=True)
+        created_dirs.add(target.parent)
+    if mode == "copy":
+        future = copy_executor.submit(copy_file, source, target)
+    else:
+        future = copy_executor.submit(link_file, source, target, mode)
+    copy_futures[target] = future
+    return future
+
+
+# Waits for all pending copies and logs the copy statistics of the current phase.
+def wait_for_copies():
+    global copy_executor
+    if copy_executor is None:
+        return
+    try:
+        for future in copy_futures.values():
+            # Raises the exception of a failed copy, just like a synchronous copy would.
+            future.result()
+    finally:
+        copy_executor.shutdown()
+        copy_executor = None
+        copy_futures.clear()
+    duration = max(time() - copy_stats["start"], 1e-6)
+    size_mb = copy_stats["bytes"] / 2**20
+    print_log(f"Copied {copy_stats['files']} files ({size_mb:.1f} MiB) in {duration:.1f} s "
+              f"({size_mb / duration:.1f} MiB/s).")
+    if copy_stats["linked"]:
+        print_log(f"Linked {copy_stats['linked']} files.")
+    for mode, files in copy_stats["fallbacks"].items():
+        print_log(f"link_mode {mode} wasn't possible for {files} files; they have been copied instead.",
+                  level=logging.WARNING)
 
 
 # Remember if the user wants to ignore all future warnings.
@@ -807,6 +1920,8 @@ def get_target(
         target: Path,
         replacements: dict,
         no_log: bool = False,
+        background: bool = False,
+        link_mode: str = "copy",
 ) -> Path:
     # Not the cleanest solution for remembering it between function calls but good enough here.
     global user_wants_inplace_warning
@@ -825,8 +1940,9 @@ def get_target(
         if target.name == "auto-existing":
             skip_copy = True
         original_source = original_root / source.relative_to(source_root)
+        replacements = compile_replacements(replacements)
         target, idgaf1, idgaf2 = recursive_root_path_replacer(original_source, to_replace=replacements)
-        target, idgaf1, idgaf2 = recursive_root_path_replacer(target, to_replace=fs_path_replacements)
+        target, idgaf1, idgaf2 = recursive_root_path_replacer(target, to_replace=compile_replacements(fs_path_replacements))
         target = Path(target)
         if not target.is_absolute():
             if target.is_relative_to("/"):
@@ -853,19 +1969,23 @@ def get_target(
                 usure = usure[0].lower().replace("j", "y")
             if usure == "n":
                 print_log("Skipping this file. If you want to abort the whole process, stop the script"
-                          "with CTRL + C.")
+                          "with CTRL + C.", level=logging.WARNING)
                 target = None
             elif usure == "a":
                 # Don't warn about this anymore.
                 user_wants_inplace_warning = False
     elif not skip_copy:
-        if not target.parent.exists():
-            target.parent.mkdir(parents=True)
-        if not no_log:
-            print_log("Copying...", target, end=" ")
-        copy(source, target)
-        if not no_log:
-            print_log("Done.")
+        if background:
+            # Nothing needs the file before the end of the phase (see wait_for_copies).
+            if not no_log:
+                print_log("Copying...", target, level=logging.DEBUG)
+            start_copy(source, target, link_mode)
+        else:
+            if not no_log:
+                print_log("Copying...", target, end=" ", level=logging.DEBUG)
+            start_copy(source, target).result()
+            if not no_log:
+                print_log("Done.", level=logging.DEBUG)
     return target
 
 
@@ -889,25 +2009,50 @@ def process_file(
     if target.is_dir():
         return
 
+    if replace_func == recursive_id_path_replacer and not target.exists():
+        # The file may have already been moved to its new location by an interrupted run (see Journal).
+        moved, modified, ignored = recursive_id_path_replacer(target, replacements)
+        if modified and Path(moved).exists():
+            return Path(moved)
+
     if not no_log:
-        print_log("Processing", target)
+        print_log("Processing", target, level=logging.DEBUG)
 
     if copy_only:
         # No need to do any further checks.
-        return
+        return target
+
+    # Most metadata files don't contain anything to replace. No need to parse and rewrite them.
+    unmatched = skip_unmatched_files and target.suffix in (".xml", ".nfo", ".mblink", ".json") \
+        and not file_may_match(target, replacements, replace_func)
+
+    if unmatched:
+        print_log("Nothing to replace in", target, level=logging.DEBUG)
+    elif target.suffix in (".xml", ".nfo", ".mblink", ".json") or (target.suffix == ".db" and tables):
+        # The file is going to be modified. If it has been linked by a copy_only job,
+        # modifying it would modify the source file, too.
+        break_link(target)
+        journal.backup_file(target)
+
+    if unmatched:
+        pass
     elif target.suffix == ".db":
         # If it's "library.db", save it for later (see comment at declaration):
         if target.name == "library.db":
             global library_db_source_path, library_db_target_path
             library_db_source_path = source
             library_db_target_path = target
+            journal.set_state("library_db_source_path", source)
+            journal.set_state("library_db_target_path", target)
         # sqlite file. In this case table specifies which tables within that file have columns to check.
         # Iterate over those.
+        dropped_indexes = drop_secondary_indexes(target, tables)
         for table, kwargs in tables.items():
             print_log("Processing table", table)
             # The remaining function arguments (**kwards) contain the details about the columns to process.
             # See update_db_table and/or the todo_list.
             update_db_table(file=target, replace_dict=replacements, replace_func=replace_func, table=table, **kwargs)
+        restore_secondary_indexes(target, dropped_indexes)
     elif target.suffix == ".xml" or target.suffix == ".nfo":
         update_xml(file=target, replace_dict=replacements, replace_func=replace_func)
     elif target.suffix == ".mblink":
@@ -915,7 +2060,7 @@ def process_file(
         with open(target, "r", encoding="utf-8") as f:
             path = f.read()
         path, modified, ignored = replace_func(path, replacements)
-        print_log(f"Processed {modified + ignored} paths, {modified} paths have been modified.")
+        print_log(f"Processed {modified + ignored} paths, {modified} paths have been modified.", level=logging.DEBUG)
         with open(target, "w", encoding="utf-8") as f:
             f.write(path)
     elif target.suffix == ".json":
@@ -925,22 +2070,442 @@ def process_file(
         with open(target, "r", encoding="utf-8") as f:
             j = json.load(f)
         j, modified, ignored = replace_func(j, replacements)
-        print_log(f"Processed {modified + ignored} paths, {modified} paths have been modified.")
+        print_log(f"Processed {modified + ignored} paths, {modified} paths have been modified.", level=logging.DEBUG)
         with open(target, "w", encoding="utf-8") as f:
             # indent 2 seems to be the default formatting for jellyfin json files.
             json.dump(j, f, indent=2)
 
     # If we're updating path ids we also need to check the paths of the files themselves
-    # and move them if they're relative to a path.
-    # This obviously leaves empty folders behind, which are cleaned up afterwards.
-    if replace_func == recursive_id_path_replacer:
-        source = target
-        target, modified, ignored = recursive_id_path_replacer(source, replacements)
-        if modified:
-            print_log("Changing ID in filepath: ->", target)
-            target = Path(target)
-            target.parent.mkdir(parents=True, exist_ok=True)
-            source.replace(target)
+    # and move them if they're relative to a path. This is done by process_files once all
+    # files of the job have been processed (see move_id_paths).
+    return target
+
+
+# Checkpoint journal (see journal_file). It records
+#   * finished phases of the migration (see __main__),
+#   * finished jobs of each todo_list,
+#   * every processed file with size and modification time of its target and
+#   * the IDs computed by get_ids
+# which allows a restarted migration (--resume) to skip all finished work. A file only counts
+# as finished if its target still has the recorded size and modification time; otherwise
+# it's processed again (and so is its job).
+# Jobs working on existing files (f.ex. the ID phases, see in_place_job) can't simply process
+# an interrupted file again: its IDs would be replaced twice. Such files are therefore backed
+# up before they're modified (see backup_file) and restored if the job is resumed.
+class Journal:
+    def __init__(self):
+        self.con = None
+        # Files waiting to be written to the journal, see file_done.
+        self.pending = []
+        self.last_commit = 0
+        # Backups of the files modified in place by the current job, None if it doesn't modify
+        # files in place (see start_job).
+        self.file = None
+        self.backup_root = None
+        self.backup_folder = None
+        self.restore = False
+
+    def open(self, file: Path, resume: bool = False):
+        file = Path(file)
+        if not resume and file.exists():
+            file.unlink()
+        elif resume and not file.exists():
+            print_log("No journal found, starting the migration from the beginning.", level=logging.WARNING)
+        file.parent.mkdir(parents=True, exist_ok=True)
+        self.file = file
+        self.backup_root = file.with_name(file.name + "-backups")
+        if not resume and self.backup_root.exists():
+            shutil.rmtree(self.backup_root)
+        self.con = connect_db(file)
+        self.con.executescript("""
+            CREATE TABLE IF NOT EXISTS `phases` (`phase` TEXT PRIMARY KEY);
+            CREATE TABLE IF NOT EXISTS `jobs` (`phase` TEXT, `job` INTEGER, PRIMARY KEY (`phase`, `job`));
+            CREATE TABLE IF NOT EXISTS `files` (`phase` TEXT, `job` INTEGER, `source` TEXT, `target` TEXT,
+                                                `size` INTEGER, `mtime_ns` INTEGER, PRIMARY KEY (`phase`, `source`));
+            CREATE TABLE IF NOT EXISTS `ids` (`id_type` TEXT, `old` BLOB, `new` BLOB, PRIMARY KEY (`id_type`, `old`));
+            CREATE TABLE IF NOT EXISTS `state` (`key` TEXT PRIMARY KEY, `value` TEXT);
+        """)
+        self.con.commit()
+
+    def phase_done(self, phase: str) -> bool:
+        if self.con is None:
+            return False
+        return self.con.execute("SELECT 1 FROM `phases` WHERE `phase` = ?", (phase,)).fetchone() is not None
+
+    def finish_phase(self, phase: str):
+        if self.con is None:
+            return
+        self.flush(wait=True)
+        self.con.execute("INSERT OR IGNORE INTO `phases` VALUES (?)", (phase,))
+        self.con.commit()
+        # Backups left behind by jobs that have been finished right before an interruption.
+        shutil.rmtree(self.backup_root / phase, ignore_errors=True)
+
+    def job_done(self, phase: str, job: int) -> bool:
+        if self.con is None:
+            return False
+        return self.con.execute("SELECT 1 FROM `jobs` WHERE `phase` = ? AND `job` = ?",
+                                (phase, job)).fetchone() is not None
+
+    def finish_job(self, phase: str, job: int):
+        if self.con is None:
+            return
+        self.flush(wait=True)
+        self.con.execute("INSERT OR IGNORE INTO `jobs` VALUES (?, ?)", (phase, job))
+        self.con.commit()
+        if self.backup_folder is not None:
+            shutil.rmtree(self.backup_folder, ignore_errors=True)
+            self.backup_folder = None
+
+    # Called before the files of a job are processed. in_place tells whether the job modifies
+    # existing files (see in_place_job) which need to be backed up (see backup_file).
+    def start_job(self, phase: str, job: int, in_place: bool):
+        self.backup_folder = None
+        self.restore = False
+        if self.con is None or phase is None or not in_place:
+            return
+        self.backup_folder = self.backup_root / phase / str(job)
+        # Only an interrupted run of this job can have left backups behind.
+        self.restore = self.backup_folder.is_dir()
+
+    def backup_path(self, file: Path) -> Path:
+        return self.backup_folder / hashlib.md5(str(file).encode("utf-8")).hexdigest()
+
+    # Keeps a copy of file until the current job is finished. Must be called before modifying
+    # a file. If there's already a backup (from an interrupted run), it's kept since it contains
+    # the state from before the job.
+    def backup_file(self, file: Path):
+        if self.backup_folder is None:
+            return
+        backup = self.backup_path(file)
+        if backup.exists():
+            return
+        backup.parent.mkdir(parents=True, exist_ok=True)
+        tmp = backup.with_name(backup.name + ".jf-migrator-tmp")
+        shutil.copyfile(file, tmp)
+        os.replace(tmp, backup)
+
+    # Restores the state of file from before the current job if an interrupted run already
+    # started modifying it (see backup_file). Files that have been moved to their new ID path
+    # are left alone; they've been completely processed (see move_id_paths).
+    def restore_file(self, file: Path):
+        if not self.restore or file is None:
+            return
+        backup = self.backup_path(file)
+        if not backup.exists() or not file.exists():
+            return
+        print_log("Restoring", file, "from before the interrupted run.", level=logging.WARNING)
+        if file.suffix == ".db":
+            # The journal of an interrupted transaction would be applied to the restored database.
+            for suffix in ("-journal", "-wal", "-shm"):
+                file.with_name(file.name + suffix).unlink(missing_ok=True)
+        tmp = file.with_name(file.name + ".jf-migrator-tmp")
+        shutil.copyfile(backup, tmp)
+        os.replace(tmp, file)
+
+    # Returns the sources of all verified files of the given phase and the jobs that need
+    # to be processed again since some of their files failed the verification.
+    def load_files(self, phase: str):
+        done = set()
+        failed_jobs = set()
+        if self.con is None:
+            return done, failed_jobs
+        rows = self.con.execute("SELECT `job`, `source`, `target`, `size`, `mtime_ns` FROM `files` WHERE `phase` = ?",
+                                (phase,)).fetchall()
+        for job, source, target, size, mtime_ns in rows:
+            try:
+                st = os.stat(target)
+                valid = st.st_size == size and st.st_mtime_ns == mtime_ns
+            except OSError:
+                valid = False
+            if valid:
+                done.add(source)
+            else:
+                failed_jobs.add(job)
+        if failed_jobs:
+            print_log(f"{len(rows) - len(done)} finished files have been modified since the last run; "
+                      f"they will be processed again.", level=logging.WARNING)
+            self.con.executemany("DELETE FROM `jobs` WHERE `phase` = ? AND `job` = ?",
+                                 [(phase, job) for job in failed_jobs])
+            self.con.commit()
+        return done, failed_jobs
+
+    # Records that source has been processed. If the target is still being copied in the
+    # background, future is the copy job (see start_copy) and the file is recorded once
+    # it's finished.
+    def file_done(self, phase: str, job: int, source, target, future=None):
+        if self.con is None or target is None:
+            return
+        self.pending.append((future, (phase, job, str(source), str(target))))
+        # Committing each file individually would be way too slow.
+        if time() - self.last_commit > 1:
+            self.flush()
+
+    def flush(self, wait: bool = False):
+        if self.con is None:
+            return
+        rows = []
+        pending = []
+        for future, (phase, job, source, target) in self.pending:
+            if future is not None and not future.done():
+                if not wait:
+                    pending.append((future, (phase, job, source, target)))
+                    continue
+            if future is not None and future.exception() is not None:
+                # Not finished; the exception is raised by wait_for_copies.
+                continue
+            try:
+                st = os.stat(target)
+            except OSError:
+                continue
+            rows.append((phase, job, source, target, st.st_size, st.st_mtime_ns))
+        self.pending = pending
+        self.con.executemany("INSERT OR REPLACE INTO `files` VALUES (?, ?, ?, ?, ?, ?)", rows)
+        self.con.commit()
+        self.last_commit = time()
+
+    def set_state(self, key: str, value):
+        if self.con is None:
+            return
+        self.con.execute("INSERT OR REPLACE INTO `state` VALUES (?, ?)", (key, str(value)))
+        self.con.commit()
+
+    def get_state(self, key: str, default=None):
+        if self.con is None:
+            return default
+        row = self.con.execute("SELECT `value` FROM `state` WHERE `key` = ?", (key,)).fetchone()
+        return default if row is None else row[0]
+
+    # Only the binary IDs are stored; the other formats are derived from them (see IdMap).
+    def save_ids(self, ids: "IdMap"):
+        if self.con is None:
+            return
+        self.con.execute("DELETE FROM `ids`")
+        self.con.executemany("INSERT INTO `ids` VALUES ('bin', ?, ?)", ids["bin"].items())
+        self.con.commit()
+
+    def load_ids(self) -> "IdMap":
+        rows = self.con.execute("SELECT `old`, `new` FROM `ids` WHERE `id_type` = 'bin'").fetchall()
+        return IdMap([old for old, new in rows], [new for old, new in rows])
+
+    def close(self):
+        if self.con is None:
+            return
+        self.flush(wait=True)
+        self.con.close()
+        self.con = None
+        try:
+            # Only removed if all the backups have been removed, too (see finish_phase).
+            self.backup_root.rmdir()
+        except OSError:
+            pass
+
+    # Deletes the journal once the migration is complete. Otherwise, it would end up on the new
+    # server together with the rest of target_root.
+    def remove(self):
+        self.close()
+        if self.file is not None:
+            for suffix in ("", "-journal", "-wal", "-shm"):
+                self.file.with_name(self.file.name + suffix).unlink(missing_ok=True)
+
+
+# Does nothing until it's opened in __main__.
+journal = Journal()
+# Save as much progress as possible if the script is aborted.
+atexit.register(lambda: journal.con is not None and journal.flush())
+
+
+# Index of all files in source_root. It's built once with a single walk through the directory
+# tree (which can be very slow on network drives) and then used by all jobs of all todo_lists.
+# Files are identified by their position in the index, which allows process_files to keep
+# track of the processed files with a simple bytearray.
+class SourceIndex:
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        # Paths relative to root, with "/" as separator.
+        self.files = []
+        self.ids = None
+        # Same order as Path.glob: the files of a folder, then its subfolders (recursively).
+        folders = [""]
+        while folders:
+            folder = folders.pop()
+            subfolders = []
+            try:
+                with os.scandir(os.path.join(self.root, folder)) as entries:
+                    for entry in entries:
+                        rel = folder + entry.name
+                        # Like Path.glob, don't follow symlinks to folders when walking recursively.
+                        if entry.is_dir(follow_symlinks=False):
+                            subfolders.append(rel + "/")
+                        elif not entry.is_dir():
+                            self.files.append(rel)
+            except OSError:
+                # Path.glob silently ignores folders it can't read, too.
+                continue
+            folders.extend(reversed(subfolders))
+
+    # Translates a glob pattern (same syntax as Path.glob) into a regex matching the
+    # relative paths in self.files.
+    @staticmethod
+    def compile_pattern(pattern: str):
+        parts = pathlib.PurePath(pattern).parts
+        regex = ""
+        for i, part in enumerate(parts):
+            last = i == len(parts) - 1
+            if part == "**":
+                if last:
+                    # Path.glob returns only folders in this case.
+                    return None
+                # Any number of folders, including none.
+                regex += "(?:[^/]+/)*"
+                continue
+            j = 0
+            while j < len(part):
+                c = part[j]
+                j += 1
+                if c == "*":
+                    regex += "[^/]*"
+                elif c == "?":
+                    regex += "[^/]"
+                elif c == "[":
+                    # Character set like [a-z] or [!0-9] (same rules as fnmatch). A "]" right
+                    # after the opening bracket is part of the set.
+                    end = part.find("]", j + 2 if part[j:j + 1] == "!" else j + 1)
+                    if end < 0:
+                        # No closing bracket, so it's just a regular character.
+                        regex += re.escape(c)
+                        continue
+                    chars = part[j:end].replace("\\", "\\\\").replace("[", "\\[")
+                    j = end + 1
+                    if chars.startswith("!"):
+                        chars = "^" + chars[1:]
+                    elif chars.startswith("^"):
+                        chars = "\\" + chars
+                    regex += "[" + chars + "]"
+                else:
+                    regex += re.escape(c)
+            if not last:
+                regex += "/"
+        # Path.glob is case-insensitive on Windows.
+        return re.compile(regex, re.IGNORECASE if os.name == "nt" else 0)
+
+    # Returns the ids of all files matching the pattern (relative to root).
+    def glob(self, pattern: str) -> list:
+        regex = self.compile_pattern(pattern)
+        if regex is None:
+            return []
+        return [i for i, file in enumerate(self.files) if regex.fullmatch(file)]
+
+    # Returns the id of the given (absolute) path or None if it's not part of the index.
+    def id(self, path):
+        if self.ids is None:
+            self.ids = {file: i for i, file in enumerate(self.files)}
+        try:
+            rel = Path(path).relative_to(self.root).as_posix()
+        except ValueError:
+            return None
+        return self.ids.get(rel)
+
+    def path(self, file_id: int) -> Path:
+        return self.root / self.files[file_id]
+
+
+# Built on first use by get_source_index.
+source_index = None
+
+
+def get_source_index() -> SourceIndex:
+    global source_index
+    # If the target is (within) the source folder, the source folder changes during the
+    # migration and the index has to be rebuilt every time.
+    changing = target_root.is_relative_to(source_root) or source_root.is_relative_to(target_root)
+    if source_index is None or changing:
+        print_log("Indexing source files...")
+        source_index = SourceIndex(source_root)
+        print_log(f"Found {len(source_index.files)} files.")
+    return source_index
+
+
+# Returns all files within folder and its subfolders. Symbolic links to folders are listed
+# like files (they're not followed).
+def walk_files(folder: Path) -> list:
+    files = []
+    for dirpath, dirnames, filenames in os.walk(folder):
+        dirpath = Path(dirpath)
+        files.extend(dirpath / name for name in filenames)
+        files.extend(dirpath / name for name in dirnames if (dirpath / name).is_symlink())
+    return files
+
+
+# Removes folder and its parents as long as they're empty, up to (and including) last.
+def remove_empty_folders(folder: Path, last: Path):
+    while folder.is_relative_to(last):
+        try:
+            folder.rmdir()
+        except OSError:
+            # Not empty (or already gone).
+            return
+        folder = folder.parent
+
+
+# Moves the files of the ID phase to their new paths (see recursive_id_path_replacer).
+# files is a list of (source, target) tuples; target is the current location of the file.
+# The metadata is organized in folders named after the IDs (f.ex. .../83/833addde.../*). Most
+# files therefore only change their path because of such a folder. The files are grouped by
+# that folder; if a group contains all the files of the folder, the whole folder is moved at
+# once. Otherwise (f.ex. if some files are named after an ID themselves), the files are moved
+# one by one. Folders that end up empty are removed.
+# Returns a list of (source, new target) tuples.
+def move_id_paths(files: list, replacements) -> list:
+    results = []
+    # {(old folder, new folder): [(source, target, new target), ...]}
+    groups = dict()
+    for src, target in files:
+        new_target, modified, ignored = recursive_id_path_replacer(target, replacements)
+        if not modified:
+            results.append((src, target))
+            continue
+        new_target = Path(new_target)
+        # The parts behind the ID folder stay the same.
+        old_parts, new_parts = target.parts, new_target.parts
+        n = 0
+        while n < min(len(old_parts), len(new_parts)) - 1 and old_parts[-1 - n] == new_parts[-1 - n]:
+            n += 1
+        old_folder = Path(*old_parts[:len(old_parts) - n])
+        new_folder = Path(*new_parts[:len(new_parts) - n])
+        groups.setdefault((old_folder, new_folder), []).append((src, target, new_target))
+
+    folders_moved, files_moved = 0, 0
+    for (old_folder, new_folder), group in groups.items():
+        if old_folder.is_dir() and not new_folder.exists() \
+                and set(walk_files(old_folder)) == {target for src, target, new_target in group}:
+            print_log("Changing ID in folder path: ->", new_folder, level=logging.DEBUG)
+            new_folder.parent.mkdir(parents=True, exist_ok=True)
+            old_folder.rename(new_folder)
+            results.extend((src, new_target) for src, target, new_target in group)
+            folders_moved += 1
+        else:
+            for src, target, new_target in group:
+                print_log("Changing ID in filepath: ->", new_target, level=logging.DEBUG)
+                new_target.parent.mkdir(parents=True, exist_ok=True)
+                target.replace(new_target)
+                results.append((src, new_target))
+                files_moved += 1
+                remove_empty_folders(target.parent, old_folder.parent)
+        # The parent folder (f.ex. .../83) may be empty now, too.
+        remove_empty_folders(old_folder.parent, old_folder.parent)
+    if folders_moved or files_moved:
+        print_log(f"Moved {folders_moved} folders and {files_moved} files to their new ID paths.")
+    return results
+
+
+# Returns whether the job modifies the existing files instead of fresh copies of its sources
+# (see get_target).
+def in_place_job(job: dict) -> bool:
+    if job["copy_only"]:
+        return False
+    target = Path(job["target"])
+    return (len(target.parts) == 1 and target.name == "auto-existing") or target == Path(job["source"])
 
 
 # Processes the todo_list.
@@ -955,63 +2520,100 @@ def process_file(
 # lst: job list
 # process_func: function to apply to jobs of lst.
 # replace_func: function used by process_func to do the replacing of paths, ...
-def process_files(lst: list, process_func, replace_func, path_replacements):
-    done = set()
-    for job in lst:
+def process_files(lst: list, process_func, replace_func, path_replacements, phase: str = None):
+    path_replacements = compile_replacements(path_replacements)
+    index = get_source_index()
+    # Processed files of the index by id. Files not in the index (only possible for jobs without
+    # wildcards) are tracked by path in done_other.
+    done = bytearray(len(index.files))
+    done_other = set()
+    # Skip the files that have been processed by a previous, interrupted run (see Journal).
+    journal_done, failed_jobs = journal.load_files(phase)
+    for src in journal_done:
+        file_id = index.id(src)
+        if file_id is None:
+            done_other.add(Path(src))
+        else:
+            done[file_id] = 1
+    for job_index, job in enumerate(lst):
         if "no_log" not in job:
             job["no_log"] = False
+        if "copy_only" not in job:
+            job["copy_only"] = False
+        # Files that are processed must be real copies.
+        if not job["copy_only"]:
+            job["link_mode"] = "copy"
+        elif "link_mode" not in job:
+            job["link_mode"] = link_mode
+        # Prepare the replacements once per job instead of once per file.
+        job["replacements"] = compile_replacements(job["replacements"])
         source = job["source"]
+        if journal.job_done(phase, job_index):
+            print_log(f"Skipping finished job from todo_list: {source}")
+            continue
         print_log(f"Current job from todo_list: {source}")
+        journal.start_job(phase, job_index, in_place_job(job))
         if "*" in str(source):
-            # Path has wildcards, process all matching files.
-            #
-            # Ironically Path.glob can't handle Path objects, hence the need
-            # to convert them to a string...
+            # Path has wildcards, process all matching files (see SourceIndex).
             # It is expected that all these paths are relative to source_root.
             source = source.relative_to(source_root)
-            for src in source_root.glob(str(source)):
-                if src.is_dir():
-                    continue
-                if src in done:
-                    # File has already been processed by this script.
-                    continue
-                done.add(src)
-
-                target = get_target(
-                    source=src,
-                    target=job["target"],
-                    replacements=path_replacements,
-                    no_log=job["no_log"],
-                )
-
-                # pass the job as is but with non-wildcard source path.
-                process_func(
-                    replace_func=replace_func,
-                    source=src,
-                    target=target,
-                    **{k: v for k, v in job.items() if k not in ("source", "target")},
-                )
+            sources = index.glob(str(source))
         else:
             # No wildcards, process the path directly - if it hasn't already
             # been processed.
-            if source in done:
-                continue
-            done.add(source)
+            file_id = index.id(source)
+            sources = [source if file_id is None else file_id]
+        id_path_moves = []
+        for src in sources:
+            if isinstance(src, int):
+                if done[src]:
+                    # File has already been processed by this script.
+                    continue
+                done[src] = 1
+                src = index.path(src)
+            else:
+                if src in done_other:
+                    continue
+                done_other.add(src)
 
             target = get_target(
-                source=source,
+                source=src,
                 target=job["target"],
                 replacements=path_replacements,
                 no_log=job["no_log"],
+                background=job["copy_only"],
+                link_mode=job["link_mode"],
             )
+            # An interrupted run may have modified the file already.
+            journal.restore_file(target)
 
-            process_func(
+            # pass the job as is but with non-wildcard source path.
+            processed = process_func(
                 replace_func=replace_func,
-                source=source,
+                source=src,
                 target=target,
-                **{k: v for k, v in job.items() if k not in ("source", "target")},
+                **{k: v for k, v in job.items() if k not in ("source", "target", "link_mode")},
             )
+            if replace_func == recursive_id_path_replacer and processed == target:
+                # The file still needs to be moved to its new ID path (see below).
+                id_path_moves.append((src, target))
+            elif phase is not None and target is not None:
+                # process_file returns the final location of the file, which differs from target if it has been moved.
+                journal.file_done(phase, job_index, src, processed or target, copy_futures.get(target))
+        if id_path_moves:
+            # Move the files of this job with IDs in their paths. Whole folders are moved at once
+            # where possible; the files are recorded in the journal with their new location.
+            for src, target in move_id_paths(id_path_moves, job["replacements"]):
+                if phase is not None:
+                    journal.file_done(phase, job_index, src, target)
+        if phase is not None and not job["copy_only"]:
+            # Copies from copy_only jobs are finished at the end of the phase.
+            journal.finish_job(phase, job_index)
         print_log("")
+    # The next phase may need the copied files.
+    wait_for_copies()
+    if phase is not None:
+        journal.flush(wait=True)
 
 
 # Note: The .NET .Unicode method encodes as UTF16 little endian:
@@ -1020,6 +2622,289 @@ def get_dotnet_MD5(s: str):
     return hashlib.md5(s.encode("utf-16-le")).digest()
 
 
+# Rearranges the bytes of many records at once. data contains the records one after another,
+# each of them in_width bytes long. order lists for each byte of the new records from which
+# byte of the original record it's taken, or the (int) value to use if it's a bytes object.
+# Instead of handling each record on its own, each byte position is copied for all records
+# at once using extended slices.
+def shuffle_bytes(data: bytes, in_width: int, order) -> bytearray:
+    n = len(data) // in_width
+    out_width = len(order)
+    result = bytearray(n * out_width)
+    for i, j in enumerate(order):
+        if type(j) is bytes:
+            result[i::out_width] = j * n
+        else:
+            result[i::out_width] = data[j::in_width]
+    return result
+
+
+# Splits the concatenated records of data into a list of records.
+def split_records(data, width: int) -> list:
+    return [data[i:i + width] for i in range(0, len(data), width)]
+
+
+# Byte order of the ancestor IDs (see convert_ancestor_id in jellyfin_id_scanner.py).
+ancestor_byte_order = (3, 2, 1, 0, 5, 4, 7, 6, *range(8, 16))
+# Character order of the IDs with dashes (see sid2did in jellyfin_id_scanner.py).
+dashed_id_order = (*range(0, 8), b"-", *range(8, 12), b"-", *range(12, 16), b"-", *range(16, 20), b"-", *range(20, 32))
+
+
+# Converts a binary ID to its ancestor format and vice versa (see convert_ancestor_id).
+def swap_ancestor_bytes(id: bytes) -> bytes:
+    return id[3::-1] + id[5:3:-1] + id[7:5:-1] + id[8:]
+
+
+# Converts many binary IDs (concatenated in data) to the given format (see jellyfin_id_scanner.py
+# for the formats). All IDs are converted at once (see shuffle_bytes) instead of one by one.
+# Returns the list of converted IDs.
+def format_ids(data: bytes, id_type: str) -> list:
+    if id_type.startswith("ancestor-"):
+        data = bytes(shuffle_bytes(data, 16, ancestor_byte_order))
+        id_type = id_type[len("ancestor-"):]
+    if id_type == "bin":
+        return split_records(data, 16)
+    data = data.hex()
+    if id_type == "str":
+        return split_records(data, 32)
+    data = shuffle_bytes(data.encode("ascii"), 32, dashed_id_order).decode("ascii")
+    return split_records(data, 36)
+
+
+# Converts a single binary ID to the given format (see format_ids for many IDs at once).
+def format_id(bin_id: bytes, id_type: str):
+    if id_type.startswith("ancestor-"):
+        bin_id = swap_ancestor_bytes(bin_id)
+        id_type = id_type[len("ancestor-"):]
+    if id_type == "bin":
+        return bin_id
+    h = bin_id.hex()
+    if id_type == "str":
+        return h
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+
+# Converts a string ID (with or without dashes) to the binary format, without rearranging its
+# bytes (see swap_ancestor_bytes). Returns None if it isn't an ID of either format.
+def parse_id_str(id):
+    if type(id) is not str:
+        return None
+    if len(id) == 36 and id[8] == id[13] == id[18] == id[23] == "-":
+        id = id[:8] + id[9:13] + id[14:18] + id[19:23] + id[24:]
+    elif len(id) != 32:
+        return None
+    try:
+        bin_id = bytes.fromhex(id)
+    except ValueError:
+        return None
+    # fromhex also accepts upper case letters and whitespace.
+    return bin_id if bin_id.hex() == id else None
+
+
+# Converts an ID of the given format back to its binary format. Returns None if it isn't a
+# valid ID of that format.
+def parse_id(id, id_type: str):
+    if id_type.endswith("bin"):
+        if type(id) is not bytes or len(id) != 16:
+            return None
+        bin_id = id
+    else:
+        # The length tells the formats with and without dashes apart.
+        if type(id) is not str or len(id) != (36 if id_type.endswith("dash") else 32):
+            return None
+        bin_id = parse_id_str(id)
+        if bin_id is None:
+            return None
+    return swap_ancestor_bytes(bin_id) if id_type.startswith("ancestor-") else bin_id
+
+
+# Replacement table for the Jellyfin IDs (see get_ids). Libraries can have millions of items and
+# each ID exists in several formats (see jellyfin_id_scanner.py). Instead of one dict per format
+# with millions of small str/bytes objects, only the binary IDs are stored: sorted and
+# concatenated into two bytes objects (old and new IDs), plus an array with the first 8 bytes of
+# each old ID as integer for the lookups (binary search). The other formats are converted from
+# and to the binary format on the fly.
+# ids[id_type] returns a read-only dict like view of one of the formats (see IdView). It's
+# meant as drop-in replacement for the dicts that have been used before.
+class IdMap(Mapping):
+    id_types = ("bin", "str", "str-dash", "ancestor-bin", "ancestor-str", "ancestor-str-dash")
+
+    def __init__(self, old_ids=(), new_ids=()):
+        pairs = sorted(zip(old_ids, new_ids))
+        self.old = b"".join(old for old, new in pairs)
+        self.new = b"".join(new for old, new in pairs)
+        del pairs
+        # The byte order of the IDs is big endian. As integers, they have the same order.
+        self.old_keys = array("Q", bytes(shuffle_bytes(self.old, 16, range(8))))
+        if sys.byteorder == "little":
+            self.old_keys.byteswap()
+        # Position of the first old ID starting with each 2 byte prefix, such that the binary
+        # search only has to look at the few IDs with the same prefix.
+        self.prefix_starts = array("L", (bisect_left(self.old_keys, prefix << 48) for prefix in range(65537)))
+
+    def __getitem__(self, id_type: str):
+        if id_type not in self.id_types and id_type != "path":
+            raise KeyError(id_type)
+        return IdView(self, id_type)
+
+    def __iter__(self):
+        return iter(self.id_types)
+
+    def __len__(self):
+        return len(self.id_types)
+
+    # Returns the position of the given binary ID or -1 if it's not in the map.
+    def find(self, bin_id: bytes) -> int:
+        key = int.from_bytes(bin_id[:8], "big")
+        prefix = key >> 48
+        end = self.prefix_starts[prefix + 1]
+        i = bisect_left(self.old_keys, key, self.prefix_starts[prefix], end)
+        while i < end and self.old_keys[i] == key:
+            if self.old[16 * i:16 * i + 16] == bin_id:
+                return i
+            i += 1
+        return -1
+
+    # Returns the new binary ID of the given binary ID, None if it's not in the map.
+    def get_new(self, bin_id: bytes):
+        i = self.find(bin_id)
+        if i < 0:
+            return None
+        return self.new[16 * i:16 * i + 16]
+
+    # Returns the old and new IDs in the given format, converted in chunks to limit the memory usage.
+    def iter_items(self, id_type: str, chunk_size: int = 65536):
+        for start in range(0, len(self.old), 16 * chunk_size):
+            end = start + 16 * chunk_size
+            yield from zip(format_ids(self.old[start:end], id_type), format_ids(self.new[start:end], id_type))
+
+
+# Read-only dict like view of the ID replacements of one format (see IdMap). The special
+# format "path" contains all string formats, like the dict used for the paths before:
+#   {**ids["ancestor-str"], **ids["ancestor-str-dash"], **ids["str"], **ids["str-dash"]}
+# (in case of collisions, the normal formats win over the ancestor formats).
+class IdView(Mapping):
+    def __init__(self, id_map: IdMap, id_type: str):
+        self.id_map = id_map
+        self.id_type = id_type
+        if id_type == "path":
+            self.id_types = ("str", "str-dash", "ancestor-str", "ancestor-str-dash")
+        else:
+            self.id_types = (id_type,)
+
+    def get(self, id, default=None):
+        if self.id_type != "path":
+            bin_id = parse_id(id, self.id_type)
+            new = None if bin_id is None else self.id_map.get_new(bin_id)
+            return default if new is None else format_id(new, self.id_type)
+
+        # The shape of the ID (with or without dashes) determines its format; it's converted to
+        # binary only once. Then it's looked up in the normal byte order first and in the
+        # ancestor byte order second.
+        bin_id = parse_id_str(id)
+        if bin_id is None:
+            return default
+        id_type = "str-dash" if len(id) == 36 else "str"
+        id_map = self.id_map
+        i = id_map.find(bin_id)
+        if i < 0:
+            i = id_map.find(swap_ancestor_bytes(bin_id))
+            if i < 0:
+                return default
+            id_type = "ancestor-" + id_type
+        return format_id(id_map.new[16 * i:16 * i + 16], id_type)
+
+    def __getitem__(self, id):
+        new = self.get(id)
+        if new is None:
+            raise KeyError(id)
+        return new
+
+    def __contains__(self, id):
+        return self.get(id) is not None
+
+    def items(self):
+        for id_type in self.id_types[::-1]:
+            yield from self.id_map.iter_items(id_type)
+
+    def values(self):
+        for old, new in self.items():
+            yield new
+
+    def __iter__(self):
+        for old, new in self.items():
+            yield old
+
+    def __len__(self):
+        return len(self.id_map.old) // 16 * len(self.id_types)
+
+
+# Oldest SQLite version that supports all the queries of this script. resolve_id_collisions
+# needs window functions, which were added in 3.25. It's checked at startup.
+min_sqlite_version = (3, 25, 0)
+
+
+# Finds the rows of table that would violate a unique constraint once the IDs in column are
+# replaced according to the (temporary) table id_map. Of each group of colliding rows, only
+# one is kept (see id_collision_policy); the others are deleted.
+# Returns the number of collisions and deleted rows.
+def resolve_id_collisions(cur, table, column, id_map):
+    table_columns = [x[1] for x in cur.execute(f"PRAGMA table_info(`{table}`)")]
+    orders = {
+        # remapped is 1 for rows whose ID is replaced.
+        "drop-new": "`remapped` ASC, `rid` ASC",
+        "drop-old": "`remapped` DESC, `rid` DESC",
+        "keep-newest": "`DateModified` DESC, `remapped` ASC, `rid` ASC",
+    }
+    if id_collision_policy not in orders:
+        raise ValueError(f"Unknown id_collision_policy {id_collision_policy}, must be one of {tuple(orders)}.")
+    policy = id_collision_policy
+    if policy == "keep-newest" and "DateModified" not in table_columns:
+        policy = "drop-new"
+
+    collisions = 0
+    deleted = 0
+    for _, index, unique, _, _ in cur.execute(f"PRAGMA index_list(`{table}`)").fetchall():
+        index_columns = [x[2] for x in cur.execute(f"PRAGMA index_info(`{index}`)")]
+        # Changing column can't violate unique indexes of other columns.
+        if not unique or column not in index_columns or None in index_columns:
+            continue
+        # The values of the index columns after the migration.
+        keys = ", ".join(f"COALESCE(m.`new`, t.`{c}`) AS `k{i}`" if c == column else f"t.`{c}` AS `k{i}`"
+                         for i, c in enumerate(index_columns))
+        key_names = ", ".join(f"`k{i}`" for i in range(len(index_columns)))
+        not_null = " AND ".join(f"`k{i}` IS NOT NULL" for i in range(len(index_columns)))
+        date_modified = ", t.`DateModified`" if policy == "keep-newest" else ""
+        rows = cur.execute(f"""
+            WITH `final` AS (
+                SELECT t.rowid AS `rid`, m.`old` IS NOT NULL AS `remapped`{date_modified},
+                       {keys}
+                FROM `{table}` AS t LEFT JOIN temp.`{id_map}` AS m ON m.`old` = t.`{column}` COLLATE BINARY
+            ), `ranked` AS (
+                SELECT `rid`,
+                       ROW_NUMBER() OVER (PARTITION BY {key_names} ORDER BY {orders[policy]}) AS `n`,
+                       COUNT(*) OVER (PARTITION BY {key_names}) AS `count`,
+                       SUM(`remapped`) OVER (PARTITION BY {key_names}) AS `remapped_count`
+                FROM `final` WHERE {not_null}
+            )
+            SELECT `rid`, `n` FROM `ranked` WHERE `count` > 1 AND `remapped_count` > 0
+        """).fetchall()
+        if not rows:
+            continue
+        collisions += sum(1 for rid, n in rows if n == 1)
+        drop = [(rid,) for rid, n in rows if n > 1]
+        deleted += len(drop)
+        cur.execute("DROP TABLE IF EXISTS temp.`drop_rows`")
+        cur.execute("CREATE TEMP TABLE `drop_rows` (`rid` INTEGER PRIMARY KEY)")
+        cur.executemany("INSERT INTO temp.`drop_rows` VALUES (?)", drop)
+        # The deleted rows only go to the log file (unless you really want them on the console).
+        for row in cur.execute(f"SELECT * FROM `{table}` WHERE rowid IN (SELECT `rid` FROM temp.`drop_rows`)"):
+            print_log(f"Deleting duplicated entry from {table}: ", dict(zip(table_columns, row)), level=logging.DEBUG)
+        cur.execute(f"DELETE FROM `{table}` WHERE rowid IN (SELECT `rid` FROM temp.`drop_rows`)")
+        cur.execute("DROP TABLE temp.`drop_rows`")
+    return collisions, deleted
+
+
 # Derived/copied from update_db_table. I couldn't see a good way to do this without
 # copying. The data structures and processing are too different for path and id jobs.
 # Note: kwargs is due to how process_files works. It passes a lot of stuff from the
@@ -1035,42 +2920,62 @@ def update_db_table_ids(
 
     print_log("Updating Item IDs in database... ")
 
+    # Don't modify the source file if this file has been linked by a copy_only job.
+    break_link(target)
+    journal.backup_file(target)
+    dropped_indexes = drop_secondary_indexes(target, tables)
+
     # Initialize sqlite3 objects
-    con = sqlite3.connect(target)
+    con = connect_db(target, profile=db_profile)
     cur = con.cursor()
 
     updated_ids_count = 0
-    # That's a very nested loop and could probably be written more efficiently using
-    # multiprocessing and more advanced sqlite queries.
+    # (table, column, collisions, deleted rows) for the summary at the end.
+    collisions = []
+    # The ID replacements are loaded into temporary tables (one per ID type, created when
+    # they're needed for the first time). This way each column can be updated with a single
+    # query instead of one full table scan per ID.
+    id_map_tables = dict()
     for table, columns_by_id_type in tables.items():
         for id_type, columns in columns_by_id_type.items():
+            if not columns:
+                continue
+            if id_type not in id_map_tables:
+                id_map = "id_map_" + id_type.replace("-", "_")
+                # No column types; the IDs are compared exactly like in the python dict (bytes != str).
+                cur.execute(f"DROP TABLE IF EXISTS temp.`{id_map}`")
+                cur.execute(f"CREATE TEMP TABLE `{id_map}` (`old` PRIMARY KEY, `new`)")
+                cur.executemany(f"INSERT INTO temp.`{id_map}` VALUES (?, ?)", ids[id_type].items())
+                id_map_tables[id_type] = id_map
+            id_map = id_map_tables[id_type]
             for column in columns:
                 print_log(f"Updating {column} IDs in table {table}...")
-                # See comment about iterating over rows while modifying them in update_db_table.
-                rows = [r for r in cur.execute(f"SELECT DISTINCT `{column}` from `{table}`")]
-                progress = 0
-                rowcount = len(rows)
-                t = time()
-                for old_id, in rows:
-                    progress += 1
-                    # Print the progress every second. Note: this is the only usage of the "progress" variable.
-                    now = time()
-                    if now - t > 1:
-                        print_log(f"Progress: {progress} / {rowcount} rows")
-                        t = now
-                    if old_id in ids[id_type]:
-                        new_id = ids[id_type][old_id]
-                        try:
-                            cur.execute(f"UPDATE `{table}` SET `{column}` = ? WHERE `{column}` = ?", (new_id, old_id))
-                        except sqlite3.IntegrityError:
-                            col_names  = [x[0] for x in cur.execute(f"SELECT name FROM PRAGMA_TABLE_INFO('{table}')")]
-                            rows = [x for x in cur.execute(f"SELECT * FROM `{table}` WHERE `{column}` = ?", (old_id,))]
-                            rows = [dict(zip(col_names, row)) for row in rows]
-                            print_log(f"Encountered {len(rows)} duplicated entries")
-                            for i, row in enumerate(rows):
-                                print_log(f"Deleting ({i+1}/{len(rows)}): ", row)
-                            cur.execute(f"DELETE FROM `{table}` WHERE `{column}` = ?", (old_id,))
-                        updated_ids_count += 1
+                # COLLATE BINARY: Same comparison as the python dict, even if the column has another collation.
+                match = f"`{column}` COLLATE BINARY IN (SELECT `old` FROM temp.`{id_map}`)"
+                # Remove the rows that would end up as duplicates first.
+                column_collisions, deleted = resolve_id_collisions(cur, table, column, id_map)
+                if column_collisions:
+                    collisions.append((table, column, column_collisions, deleted))
+                # Counted after the collisions have been resolved: the deleted rows aren't updated.
+                matching_ids = next(cur.execute(f"SELECT COUNT(DISTINCT `{column}`) FROM `{table}` WHERE {match}"))[0]
+                try:
+                    # Equivalent to UPDATE ... FROM (SQLite 3.33+), which isn't available in all
+                    # SQLite versions supported by this script (see min_sqlite_version).
+                    cur.execute(f"UPDATE `{table}` SET `{column}` = (SELECT `new` FROM temp.`{id_map}` "
+                                f"WHERE `old` = `{table}`.`{column}` COLLATE BINARY) WHERE {match}")
+                except sqlite3.IntegrityError:
+                    # SQLite checks unique constraints row by row. This fails if an ID is replaced
+                    # by one that's replaced itself (but later). Using unique placeholders first
+                    # avoids these temporary duplicates. The failed query didn't change anything.
+                    cur.execute("DROP TABLE IF EXISTS temp.`remap_rows`")
+                    cur.execute(f"CREATE TEMP TABLE `remap_rows` AS SELECT t.rowid AS `rid`, m.`new` AS `new` "
+                                f"FROM `{table}` AS t JOIN temp.`{id_map}` AS m ON m.`old` = t.`{column}` COLLATE BINARY")
+                    cur.execute(f"UPDATE `{table}` SET `{column}` = 'jf-migrator-' || rowid "
+                                f"WHERE rowid IN (SELECT `rid` FROM temp.`remap_rows`)")
+                    cur.execute(f"UPDATE `{table}` SET `{column}` = (SELECT `new` FROM temp.`remap_rows` "
+                                f"WHERE `rid` = `{table}`.rowid) WHERE rowid IN (SELECT `rid` FROM temp.`remap_rows`)")
+                    cur.execute("DROP TABLE temp.`remap_rows`")
+                updated_ids_count += matching_ids
 
     # Once again, this came from the development and is not required anymore, especially
     # since by default the script is working on copies of the original files.
@@ -1078,64 +2983,61 @@ def update_db_table_ids(
         # Write the updated database back to the file.
         con.commit()
     con.close()
+    restore_secondary_indexes(target, dropped_indexes)
     print_log(f"{updated_ids_count} IDs updated.")
+    if collisions:
+        print_log(f"Resolved {sum(c[2] for c in collisions)} ID collisions by deleting {sum(c[3] for c in collisions)} "
+                  f"duplicated entries (id_collision_policy = {id_collision_policy}, the deleted entries are "
+                  f"listed in the log file):", level=logging.WARNING)
+        for table, column, column_collisions, deleted in collisions:
+            print_log(f"  {table}.{column}: {column_collisions} collisions, {deleted} entries deleted",
+                      level=logging.WARNING)
 
 
 def get_ids():
     global library_db_target_path, ids
 
-    con = sqlite3.connect(library_db_target_path)
+    con = connect_db(library_db_target_path, profile=db_profile)
     cur = con.cursor()
 
-    id_replacements_bin = dict()
-    for guid, item_type, path in cur.execute("SELECT `guid`, `type`, `Path` FROM `TypedBaseItems`"):
-        if not path or path.startswith("%"):
-            continue
-
-        # Source: https://github.com/jellyfin/jellyfin/blob/7e8428e588b3f0a0574da44081098c64fe1a47d7/Emby.Server.Implementations/Library/LibraryManager.cs#L504 # noqa
-        new_guid = get_dotnet_MD5(item_type + path)
+    # The new IDs are computed by SQLite itself, calling get_dotnet_MD5 for each item. This way,
+    # only the IDs that actually change are passed back.
+    # Source: https://github.com/jellyfin/jellyfin/blob/7e8428e588b3f0a0574da44081098c64fe1a47d7/Emby.Server.Implementations/Library/LibraryManager.cs#L504 # noqa
+    con.create_function("jf_dotnet_md5", 1, get_dotnet_MD5, deterministic=True)
+    old_ids, new_ids = [], []
+    for guid, new_guid in cur.execute(
+        "SELECT `guid`, `new_guid` FROM ("
+        "    SELECT `guid`, jf_dotnet_md5(`type` || `Path`) AS `new_guid` FROM `TypedBaseItems` "
+        "    WHERE `Path` != '' AND substr(`Path`, 1, 1) != '%'"
         # Omit IDs that haven't changed at all. Happens if not _all_ paths are modified
-        if new_guid != guid:
-            id_replacements_bin[guid] = new_guid
-
-    ### Adapted from jellyfin_id_scanner
-    id_replacements_str               = {bid2sid(k): bid2sid(v) for k, v in id_replacements_bin.items()}
-    id_replacements_str_dash          = {sid2did(k): sid2did(v) for k, v in id_replacements_str.items()}
-    id_replacements_ancestor_str      = {convert_ancestor_id(k): convert_ancestor_id(v) for k, v in id_replacements_str.items()}
-    id_replacements_ancestor_bin      = {sid2bid(k): sid2bid(v) for k, v in id_replacements_ancestor_str.items()}
-    id_replacements_ancestor_str_dash = {sid2did(k):sid2did(v) for k, v in id_replacements_ancestor_str.items()}
-
-    ids = {
-        "bin": id_replacements_bin,
-        "str": id_replacements_str,
-        "str-dash": id_replacements_str_dash,
-        "ancestor-bin": id_replacements_ancestor_bin,
-        "ancestor-str": id_replacements_ancestor_str,
-        "ancestor-str-dash": id_replacements_ancestor_str_dash,
-    }
-    ### End of adapted code
+        ") WHERE `new_guid` != `guid`"
+    ):
+        old_ids.append(guid)
+        new_ids.append(new_guid)
+
+    # All the ID formats are derived from the binary IDs when needed (see IdMap).
+    ids = IdMap(old_ids, new_ids)
 
     # Check for collisions between old and new ids in both the normal and ancestor format.
     # If there are collisions, get the (new) filepaths causing them
     uniques = set()
     duplicates = list()
-    for id in id_replacements_str.values():
+    for id in new_ids:
         if id in uniques:
             duplicates.append(id)
         else:
             uniques.add(id)
+    del uniques
 
     # if there are duplicates, find the matching old_ids to query the lines from the database
     if duplicates:
-        old_ids = []
-        for k, v in id_replacements_str.items():
-            if v in duplicates:
-                old_ids.append(sid2bid(k))
+        duplicates_set = set(duplicates)
+        old_ids = [k for k, v in zip(old_ids, new_ids) if v in duplicates_set]
 
         duplicates_new = [next(cur.execute("SELECT `guid`, `Path` FROM `TypedBaseItems` WHERE `guid` = ?", (guid,))) for guid in old_ids]
         # also fetch the old paths for better understanding/debugging
         con.close()
-        con = sqlite3.connect(library_db_source_path)
+        con = connect_db(library_db_source_path, read_only=True)
         cur = con.cursor()
         duplicates_old = [next(cur.execute("SELECT `guid`, `Path` FROM `TypedBaseItems` WHERE `guid` = ?", (guid,))) for guid in old_ids]
         duplicates_old = dict(duplicates_old)
@@ -1145,11 +3047,14 @@ def get_ids():
                   f"merging media files from different directories into fewer ones. If that's the case for all the "
                   f"collisions listed below, you can likely ignore this warning, otherwise recheck your path settings. "
                   f"IMPORTANT: The duplicated entries will be removed from the database. You got a backup of the "
-                  f"database, right?")
-        print_log("Duplicates: ")
+                  f"database, right?", level=logging.WARNING)
+        print_log("Duplicates: ", level=logging.WARNING)
         for id, newpath in duplicates_new:
-            print_log(f"  Item ID: {bid2sid(id)},  Paths (old -> new): {duplicates_old[id]} -> {newpath}")
+            print_log(f"  Item ID: {bid2sid(id)},  Paths (old -> new): {duplicates_old[id]} -> {newpath}",
+                      level=logging.WARNING)
         input("Press Enter to continue or CTRL+C to abort. ")
+    else:
+        con.close()
 
     return ids
 
@@ -1158,7 +3063,24 @@ def update_ids():
     return
 
 
+# Layout of the dates in the jellyfin database, f.ex. "2021-05-03 10:11:12.1234567Z".
+jf_date_pattern = re.compile(r"(\d{4})-(\d\d)-(\d\d)[ T](\d\d):(\d\d):(\d\d)(?:\.(\d{1,9}))?(?:Z|\+00:00)?")
+epoch_ordinal = datetime.date(1970, 1, 1).toordinal()
+
+
 def jf_date_str_to_python_ns(s: str):
+    # Fast path for the usual layout: compute the timestamp directly from the numbers
+    # instead of letting datetime parse (and validate) the whole thing.
+    m = jf_date_pattern.fullmatch(s)
+    if m is not None:
+        year, month, day, hours, minutes, seconds, subseconds = m.groups()
+        hours, minutes, seconds = int(hours), int(minutes), int(seconds)
+        # Invalid times are left to the slow path (which rejects them, just like invalid dates).
+        if hours < 24 and minutes < 60 and seconds < 60:
+            t = datetime.date(int(year), int(month), int(day)).toordinal() - epoch_ordinal
+            t = ((t * 24 + hours) * 60 + minutes) * 60 + seconds
+            return t * 1000000000 + int((subseconds or "0").ljust(9, "0"))
+
     # Python datetime has only support for microseconds because of resolution
     # problems. To convert from a date+time to ticks, the fractional seconds
     # part doesn't matter anyway (it remains the same). Hence, it's cut off
@@ -1204,39 +3126,73 @@ def delete_empty_folders(dir:str):
         done = True
         for p in dir.glob("**"):
             if not list(p.iterdir()):
-                print_log("Removing empty folder", p)
+                print_log("Removing empty folder", p, level=logging.DEBUG)
                 p.rmdir()
                 done = False
 
 
+# Reads the stats of some files in the same folder.
+# Returns a dict {name: stats} where stats is the os.stat_result or None if the file doesn't exist.
+# On Windows, the stats are part of the folder listing. If there are many files, the folder is
+# therefore listed with os.scandir. Elsewhere, scandir's entry.stat() would still access each
+# file on its own, making the listing pure overhead.
+def stat_folder(folder: Path, names: set) -> dict:
+    results = dict()
+    entries = dict()
+    if os.name == "nt" and len(names) >= stat_scandir_threshold:
+        try:
+            with os.scandir(folder) as it:
+                entries = {entry.name: entry for entry in it}
+        except OSError:
+            pass
+    for name in names:
+        entry = entries.get(name)
+        try:
+            if entry is not None:
+                results[name] = entry.stat()
+            else:
+                # Not listed (or not scanned at all). Could still exist on case insensitive
+                # file systems, so ask the file system directly.
+                results[name] = os.stat(folder / name)
+        except OSError:
+            results[name] = None
+    return results
+
+
 def update_file_dates():
     global library_db_target_path, fs_path_replacements
 
     print_log("Updating file dates... Note: Reading file dates seems to be quite slow. "
               "This will take a couple minutes")
 
-    con = sqlite3.connect(library_db_target_path)
+    con = connect_db(library_db_target_path, profile=db_profile)
     cur = con.cursor()
 
-    rows = [r for r in cur.execute("SELECT `rowid`, `Path`, `DateCreated`, `DateModified` FROM `TypedBaseItems`")]
-
-    progress = 0
-    rowcount = len(rows)
-    t = time()
-
+    # Only the dates before 1970 (f.ex. 0001-01-01) need to be updated. The dates are stored as
+    # ISO like strings, hence SQLite can filter them with a simple string comparison. It's a bit
+    # generous (in case of time zones); the dates are checked again below.
+    rows = [r for r in cur.execute(
+        "SELECT `rowid`, `Path`, `DateCreated`, `DateModified` FROM `TypedBaseItems` "
+        "WHERE `DateCreated` < '1970-01-02' OR `DateModified` < '1970-01-02'"
+    )]
+    replacements = compile_replacements(fs_path_replacements)
+
+    # Group the files by folder, so the files of a folder can be read together (see stat_folder).
+    # {folder: {names}}
+    folders = dict()
+    # (rowid, target, date_created_ns, date_modified_ns)
+    files = []
     for rowid, target, date_created, date_modified in rows:
-        progress += 1
-        # Print the progress every second. Note: this is the only usage of the "progress" variable.
-        now = time()
-        if now - t > 1:
-            print_log(f"Progress: {progress} / {rowcount} rows")
-            t = now
-
         if not target:
             continue
+        date_created_ns  = jf_date_str_to_python_ns(date_created) if date_created else 0
+        date_modified_ns = jf_date_str_to_python_ns(date_modified) if date_modified else 0
+        if date_created_ns >= 0 and date_modified_ns >= 0:
+            continue
+
         # Determine file path as seen by this script (see fs_path_replacements for details)
         # Code taken from get_target
-        target, idgaf1, idgaf2 = recursive_root_path_replacer(target, to_replace=fs_path_replacements)
+        target, idgaf1, idgaf2 = recursive_root_path_replacer(target, to_replace=replacements)
         target = Path(target)
         if not target.is_absolute():
             if target.is_relative_to("/"):
@@ -1246,81 +3202,146 @@ def update_file_dates():
             target = target_root / target
         # End of code taken from get_target
 
-        if not target.exists():
-            print_log("File doesn't seem to exist; can't update its dates in the database: ", target)
-            continue
-
-        date_created_ns  = jf_date_str_to_python_ns(date_created)
-        date_modified_ns = jf_date_str_to_python_ns(date_modified)
+        folders.setdefault(target.parent, set()).add(target.name)
+        files.append((rowid, target, date_created_ns, date_modified_ns))
 
-        if date_created_ns >= 0 and date_modified_ns >= 0:
+    # Read the stats of all files, each file exactly once. Accessing the files takes most of
+    # the time, hence multiple threads are doing it at the same time.
+    stats = dict()
+    progress = 0
+    rowcount = len(rows)
+    t = time()
+    with ThreadPoolExecutor(max_workers=max(1, stat_workers)) as executor:
+        for folder, results in zip(folders, executor.map(stat_folder, folders, folders.values())):
+            for name, filestats in results.items():
+                stats[folder / name] = filestats
+            # Print the progress every second. Note: this is the only usage of the "progress" variable.
+            progress += len(results)
+            now = time()
+            if now - t > 1:
+                print_log(f"Progress: {progress} / {rowcount} files")
+                t = now
+
+    new_dates_created, new_dates_modified = [], []
+    for rowid, target, date_created_ns, date_modified_ns in files:
+        filestats = stats[target]
+        if filestats is None:
+            print_log("File doesn't seem to exist; can't update its dates in the database: ", target,
+                      level=logging.WARNING)
             continue
 
-        filestats = os.stat(target)
-
         if date_created_ns < 0:
-            new_date_created = get_datestr_from_python_time_ns(filestats.st_ctime_ns)
-            cur.execute("UPDATE `TypedBaseItems` SET `DateCreated` = ? WHERE `rowid` = ?",
-                        (new_date_created, rowid))
+            new_dates_created.append((get_datestr_from_python_time_ns(filestats.st_ctime_ns), rowid))
         if date_modified_ns < 0:
-            new_date_modified = get_datestr_from_python_time_ns(filestats.st_mtime_ns)
-            cur.execute("UPDATE `TypedBaseItems` SET `DateModified` = ? WHERE `rowid` = ?",
-                        (new_date_modified, rowid))
+            new_dates_modified.append((get_datestr_from_python_time_ns(filestats.st_mtime_ns), rowid))
+
+    cur.executemany("UPDATE `TypedBaseItems` SET `DateCreated` = ? WHERE `rowid` = ?", new_dates_created)
+    cur.executemany("UPDATE `TypedBaseItems` SET `DateModified` = ? WHERE `rowid` = ?", new_dates_modified)
 
     con.commit()
+    con.close()
     print_log("Done.")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Jellyfin Migrator - Adjusts your Jellyfin database to run on a "
+                                                 "new system. All settings are at the beginning of this file.")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue an interrupted migration instead of starting over. Finished work "
+                             "(see journal_file) is skipped.")
+    args = parser.parse_args()
+    # Show the actual exceptions in the replacement functions called by SQLite (see
+    # update_db_table_in_sql), not just that there was one.
+    sqlite3.enable_callback_tracebacks(True)
+    if sqlite3.sqlite_version_info < min_sqlite_version:
+        print_log(f"SQLite {sqlite3.sqlite_version} is too old, at least version "
+                  f"{'.'.join(map(str, min_sqlite_version))} is required. Please update python.",
+                  level=logging.ERROR)
+        exit()
+
     print_log("")
     print_log("Starting Jellyfin Database Migration")
 
+    journal.open(journal_file, resume=args.resume)
+    # These are set while processing library.db which is skipped if it's already done.
+    library_db_source_path = Path(journal.get_state("library_db_source_path", library_db_source_path))
+    library_db_target_path = Path(journal.get_state("library_db_target_path", library_db_target_path))
+
+    # Prepare the replacement dicts for fast lookups (see compile_replacements).
+    path_replacements = compile_replacements(path_replacements)
+    fs_path_replacements = compile_replacements(fs_path_replacements)
+
+    if use_xml_tag_index:
+        load_xml_tag_index()
+
     ### Copy relevant files and adjust all paths to the new locations.
-    process_files(
-        todo_list_paths,
-        process_func=process_file,
-        replace_func=recursive_root_path_replacer,
-        path_replacements=path_replacements,
-    )
+    if not journal.phase_done("paths"):
+        process_files(
+            todo_list_paths,
+            process_func=process_file,
+            replace_func=recursive_root_path_replacer,
+            path_replacements=path_replacements,
+            phase="paths",
+        )
+        print_replacement_cache_stats()
+        journal.finish_phase("paths")
 
     ### Update IDs
-    # Generate IDs based on those new paths and save them in the global variable
-    get_ids()
+    # Generate IDs based on those new paths and save them in the global variable.
+    # They can't be generated again once the paths in library.db have been updated, hence
+    # they're stored in the journal.
+    if journal.phase_done("get_ids"):
+        ids = journal.load_ids()
+    else:
+        get_ids()
+        journal.save_ids(ids)
+        journal.finish_phase("get_ids")
     # ID types occurring in paths (<- search for that to find another comment with more details if you missed it)
     # Include/Exclude types (see get_ids) to specify which are used for looking through paths.
     # Currently, all are included, just to be safe.
-    id_replacements_path = {**ids["ancestor-str"], **ids["ancestor-str-dash"], **ids["str"], **ids["str-dash"],
-                            "target_path_slash": path_replacements["target_path_slash"]}
-
-    # To (mostly) reuse the same functions from step 1, the replacements dict needs to be updated with
-    # id_replacements_path. It can't be replaced since it's also used to find the files (which uses the
-    # same source -> target processing/conversion as step 1). In theory this alters the process since
-    # the dict used to convert from source -> target is different, in reality, this is not an issue,
-    # since step 1 only processes the roots of the paths (which cannot be similar to anything in
-    # id_replacements_path).
+    # ids["path"] contains all of them (see IdView).
+    id_replacements_path = CompiledReplacements({"target_path_slash": path_replacements["target_path_slash"]},
+                                                ids=ids["path"])
+
     for i, job in enumerate(todo_list_id_paths):
         todo_list_id_paths[i]["replacements"] = id_replacements_path
 
     # Replace all paths with ids - both in the file system and within files.
-    process_files(
-        todo_list_id_paths,
-        process_func=process_file,
-        replace_func=recursive_id_path_replacer,
-        path_replacements={**path_replacements, **id_replacements_path},
-    )
+    # Note: path_replacements is used to find the files (which uses the same source -> target
+    # processing/conversion as step 1). There's no need to add id_replacements_path to it, since
+    # step 1 only processes the roots of the paths (which cannot be similar to anything in
+    # id_replacements_path).
+    if not journal.phase_done("id_paths"):
+        process_files(
+            todo_list_id_paths,
+            process_func=process_file,
+            replace_func=recursive_id_path_replacer,
+            path_replacements=path_replacements,
+            phase="id_paths",
+        )
+        print_replacement_cache_stats()
+        journal.finish_phase("id_paths")
     # Clean up empty folders that may be left behind in the target directory
     #delete_empty_folders(target_root)
 
     # Replace remaining ids.
-    process_files(
-        todo_list_ids,
-        process_func=update_db_table_ids,
-        replace_func=None,
-        path_replacements = path_replacements,
-    )
+    if not journal.phase_done("ids"):
+        process_files(
+            todo_list_ids,
+            process_func=update_db_table_ids,
+            replace_func=None,
+            path_replacements = path_replacements,
+            phase="ids",
+        )
+        print_replacement_cache_stats()
+        journal.finish_phase("ids")
 
     # Finally, update the file dates in the db.
-    update_file_dates()
+    if not journal.phase_done("file_dates"):
+        update_file_dates()
+        print_replacement_cache_stats()
+        journal.finish_phase("file_dates")
+    journal.remove()
 
     print_log("")
     print_log("Jellyfin Database Migration complete.")
@@ -0,0 +1,62 @@
+import os
+import random
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import jellyfin_migrator as migrator
+
+
+class IdMapTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.log_dir = tempfile.TemporaryDirectory()
+        migrator.log_file = os.path.join(cls.log_dir.name, "log.txt")
+        rng = random.Random(20)
+        cls.old = [rng.randbytes(16) for _ in range(200)]
+        cls.new = [rng.randbytes(16) for _ in range(200)]
+        # Chain: an ID that is replaced by the old value of another ID.
+        cls.new[0] = cls.old[1]
+        cls.unknown = [rng.randbytes(16) for _ in range(20)]
+        cls.ids = migrator.IdMap(cls.old, cls.new)
+        # The dicts the IdMap replaces (see IdView).
+        cls.dicts = {id_type: dict(cls.ids[id_type].items()) for id_type in migrator.IdMap.id_types}
+        cls.dicts["path"] = {**cls.dicts["ancestor-str"], **cls.dicts["ancestor-str-dash"],
+                             **cls.dicts["str"], **cls.dicts["str-dash"]}
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.log_dir.cleanup()
+
+    def test_views_match_dicts(self):
+        for id_type, d in self.dicts.items():
+            view = self.ids[id_type]
+            self.assertEqual(len(view), len(d))
+            for old in d:
+                self.assertEqual(view.get(old), d[old])
+            for unknown in self.unknown:
+                self.assertIsNone(view.get(migrator.format_id(unknown, "str")))
+                self.assertIsNone(view.get(migrator.format_id(unknown, "bin")))
+
+    def test_id_paths_match_dicts(self):
+        paths = []
+        for i, old in enumerate(self.old + self.unknown):
+            s = migrator.format_id(old, ("str", "str-dash", "ancestor-str", "ancestor-str-dash")[i % 4])
+            paths.append(f"/config/metadata/library/{s[:2]}/{s}/poster.jpg")
+            paths.append(f"/config/data/playlists/{s}.xml")
+
+        cache_size = migrator.replacement_cache_size
+        migrator.replacement_cache_size = 0
+        try:
+            with_dict = migrator.CompiledReplacements({**self.dicts["path"], "target_path_slash": "/"})
+            with_ids = migrator.CompiledReplacements({"target_path_slash": "/"}, ids=self.ids["path"])
+            results = [with_ids.replace_id_path(p) for p in paths]
+            self.assertEqual(results, [with_dict.replace_id_path(p) for p in paths])
+        finally:
+            migrator.replacement_cache_size = cache_size
+        self.assertEqual(sum(r is not None for r in results), 2 * len(self.old))
+
+
+if __name__ == "__main__":
+    unittest.main()